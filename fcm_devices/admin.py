@@ -1,9 +1,7 @@
-from collections import defaultdict
-
 from django.contrib import admin, messages
 
 from . import service
-from .models import Device
+from .models import Device, NotificationOutbox
 
 
 @admin.register(Device)
@@ -29,41 +27,48 @@ class DeviceAdmin(admin.ModelAdmin):
         """
         Send a test notification immediately.
 
-        Will parse and represent any errors encountered, expecting a response
-        structure similar to the following:
-
-            {
-                "multicast_ids": [123456789],
-                "success": 0,
-                "failure": 1,
-                "canonical_ids": 0,
-                "results": [
-                    {"error": "InvalidRegistration"}
-                ],
-                "topic_message_id": None
-            }
+        Devices are sent to in multicast batches, in parallel if `SEND_WORKERS`
+        is set, with any errors encountered counted by their FCM error code, for
+        example "InvalidRegistration".
         """
-        success = errors = 0
-        error_counts = defaultdict(int)
-        for device in queryset.iterator():
-            response = service.get_fcm_backend().send_notification(
-                device, message_title="Testing 123", message_body="A test notification"
-            )
-            if int(response["success"]):
-                success += 1
-            elif int(response["failure"]):
-                errors += 1
-                for e in response["results"]:
-                    error_counts[e.get("error")] += 1
-        if success:
+        result = service.send_notification_bulk(
+            queryset, message_title="Testing 123", message_body="A test notification"
+        )
+        if result.success:
             self.message_user(
-                request, f"{success} notifications were sent successfully."
+                request, f"{result.success} notifications were sent successfully."
             )
-        if errors:
+        if result.failure:
             self.message_user(
                 request,
-                f"{errors} notifications hit errors: {dict(error_counts)}",
+                f"{result.failure} notifications hit errors: "
+                f"{dict(result.error_counts)}",
                 level=messages.WARNING,
             )
+        if result.exceptions:
+            self.message_user(
+                request,
+                f"{sum(len(devices) for devices, _ in result.exceptions)} "
+                f"notifications could not be sent: "
+                f"{', '.join(repr(e) for _, e in result.exceptions)}",
+                level=messages.ERROR,
+            )
 
     send_notification.short_description = "Send test notification (immediate)"
+
+
+@admin.register(NotificationOutbox)
+class NotificationOutboxAdmin(admin.ModelAdmin):
+
+    list_display = [
+        "id",
+        "device",
+        "status",
+        "attempts",
+        "error",
+        "created_at",
+        "sent_at",
+    ]
+    list_filter = ["status", "error"]
+    list_select_related = ("device__user",)
+    raw_id_fields = ("device",)
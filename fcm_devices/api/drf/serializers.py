@@ -1,8 +1,49 @@
 from konst.extras.drf.fields import ConstantChoiceField
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
 from ...models import Device
-from ...service import update_or_create_device
+from ...service import bulk_update_or_create_devices, update_or_create_device
+from ...settings import app_settings
+
+
+class DeviceListSerializer(serializers.ListSerializer):
+    """
+    Register many devices at once with a batched upsert, reporting whether
+    each was created, updated or unchanged.
+    """
+
+    def to_internal_value(self, data):
+        # refuse oversized lists before validating each of their items
+        if isinstance(data, list) and len(data) > app_settings.BULK_MAX_DEVICES:
+            raise serializers.ValidationError(
+                {
+                    api_settings.NON_FIELD_ERRORS_KEY: [
+                        "No more than {} devices may be registered at once.".format(
+                            app_settings.BULK_MAX_DEVICES
+                        )
+                    ]
+                }
+            )
+        return super().to_internal_value(data)
+
+    def validate(self, attrs):
+        tokens = [item["token"] for item in attrs]
+        if len(set(tokens)) != len(tokens):
+            raise serializers.ValidationError("Each token may only appear once.")
+        return attrs
+
+    def create(self, validated_data):
+        request = self.context["request"]
+        results = bulk_update_or_create_devices(request.user, validated_data)
+        self.statuses = [status for _, status in results]
+        return [instance for instance, _ in results]
+
+    def to_representation(self, data):
+        representation = super().to_representation(data)
+        for item, status in zip(representation, getattr(self, "statuses", [])):
+            item["status"] = status
+        return representation
 
 
 class DeviceSerializer(serializers.ModelSerializer):
@@ -11,6 +52,9 @@ class DeviceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Device
         fields = ("token", "name", "active", "type")
+        list_serializer_class = DeviceListSerializer
+        # as for the model, so every registration has a value to write
+        extra_kwargs = {"active": {"default": True}}
 
     def create(self, validated_data):
         request = self.context["request"]
@@ -1,5 +1,7 @@
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 
 from ...models import Device
 from .serializers import DeviceSerializer
@@ -42,6 +44,23 @@ class DeviceViewSet(viewsets.ModelViewSet):
             "active": <boolean>
         }
 
+    ### Registering many devices at once ###
+
+    To register or refresh many tokens in one request POST a list of devices
+    to the bulk endpoint. Each is reported back with a status of "created",
+    "updated" or "unchanged".
+
+        POST /v1/device/fcm/bulk
+        [
+            {
+                "name": <unicode>,
+                "type": "ios" | "android" | "web",
+                "token": <fcm token string>,
+                "active": <boolean>
+            },
+            ...
+        ]
+
     """
 
     permission_classes = (IsAuthenticated,)
@@ -50,3 +69,10 @@ class DeviceViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self, *args, **kwargs):
         return Device.objects.filter(user=self.request.user)
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class FCMDevicesConfig(AppConfig):
     name = "fcm_devices"
     verbose_name = "FCM Devices"
+
+    def ready(self):
+        # connect the cache invalidation receivers
+        from . import cache  # noqa: F401
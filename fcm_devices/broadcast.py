@@ -0,0 +1,304 @@
+from collections import Counter
+from functools import lru_cache
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import queue
+import time
+
+from django.db import connections
+from django.db.models import Max, Min
+
+from .fcm import get_fcm_backend
+from .models import Device
+from .service import iter_device_pages
+from .settings import app_settings
+
+
+class BroadcastError(Exception):
+    pass
+
+
+class CheckpointError(BroadcastError):
+    pass
+
+
+@lru_cache(maxsize=None)
+def read_user_ids(path):
+    """Read a file of user ids, one per line, in order and without repeats."""
+    with open(path) as f:
+        return tuple(sorted({int(line) for line in f if line.strip()}))
+
+
+@lru_cache(maxsize=None)
+def read_user_id_set(path):
+    return frozenset(read_user_ids(path))
+
+
+def get_devices(types=None, include_inactive=False):
+    """The devices a broadcast is for, before filtering by user."""
+    queryset = Device.objects.all()
+    if not include_inactive:
+        queryset = queryset.filter(active=True)
+    if types:
+        queryset = queryset.filter(type__in=types)
+    return queryset
+
+
+def partition(audience, count):
+    """
+    Split an audience into up to `count` partitions as `[start, end]` pairs.
+
+    These are ranges of device ids of equal width, with the last open-ended.
+    Given a user ids file they're instead slices of its ids, as many more as it
+    takes for none to have over `DB_BATCH_SIZE`, so each slice can be sent to
+    the database in one query.
+    """
+    path = audience.get("user_ids_file")
+    if path:
+        user_ids = read_user_ids(path)
+        if not user_ids:
+            return []
+        size = min(math.ceil(len(user_ids) / count), app_settings.DB_BATCH_SIZE)
+        return [[start, start + size] for start in range(0, len(user_ids), size)]
+    queryset = get_devices(audience.get("types"), audience.get("include_inactive"))
+    bounds = queryset.aggregate(start=Min("id"), end=Max("id"))
+    if bounds["start"] is None:
+        return []
+    width = math.ceil((bounds["end"] - bounds["start"] + 1) / count)
+    starts = range(bounds["start"], bounds["end"] + 1, width)
+    return [[start, start + width - 1] for start in starts[:-1]] + [[starts[-1], None]]
+
+
+def send_partition(index, partition, kwargs, audience, report):
+    """
+    Send to the devices in one partition of an audience, a page at a time,
+    calling `report(index, last_id, summary)` after each page.
+
+    A token is only sent to for the lowest id device in the whole audience
+    with it, so it isn't sent to again by another partition.
+    """
+    backend = get_fcm_backend()
+    devices = get_devices(audience.get("types"), audience.get("include_inactive"))
+    path = audience.get("user_ids_file")
+    user_ids = None
+    if path:
+        start, end = partition["start"], partition["end"]
+        queryset = devices.filter(user_id__in=read_user_ids(path)[start:end])
+        user_ids = read_user_id_set(path)
+    else:
+        queryset = devices.filter(id__gte=partition["start"])
+        if partition["end"] is not None:
+            queryset = queryset.filter(id__lte=partition["end"])
+    pages = iter_device_pages(
+        queryset,
+        backend,
+        active=None,
+        after=partition["after"],
+        audience=devices,
+        user_ids=user_ids,
+    )
+    for page in pages:
+        result = backend.send_bulk(page, **kwargs)
+        report(
+            index,
+            page[-1].id,
+            {
+                "devices": len(page),
+                "success": result.success,
+                "failure": result.failure,
+                "deactivated": len(result.deactivated),
+                "exceptions": sum(len(chunk) for chunk, _ in result.exceptions),
+                "errors": dict(result.error_counts),
+            },
+        )
+
+
+# set in each worker process, see `init_worker`
+_reports = None
+
+
+def init_worker(reports):
+    global _reports
+    import django
+
+    # not needed when forked, but spawned processes start from scratch
+    django.setup()
+    _reports = reports
+
+
+def run_partition(index, partition, kwargs, audience):
+    """Send one partition in a worker process, reporting back on a queue."""
+    try:
+        send_partition(
+            index,
+            partition,
+            kwargs,
+            audience,
+            lambda *report: _reports.put(("page", report)),
+        )
+    finally:
+        connections.close_all()
+    # reports and results travel separately, so say we're done after the last
+    _reports.put(("done", index))
+
+
+class Broadcast(object):
+    """
+    Send a notification to an audience of devices, split into partitions sent
+    by a pool of `workers` processes, see `partition`. Each token is sent to
+    once, however many devices in the audience have it.
+
+    Each process has its own database connections and FCM clients. Progress is
+    passed to `progress` every `progress_interval` seconds and, if given, saved
+    to a `checkpoint` file, from which a broadcast that stopped part way can
+    carry on. The file is removed once the broadcast is done.
+    """
+
+    def __init__(
+        self,
+        kwargs,
+        audience,
+        workers=1,
+        partitions=None,
+        checkpoint=None,
+        progress=None,
+        progress_interval=10,
+    ):
+        self.kwargs = kwargs
+        self.audience = audience
+        self.workers = workers
+        self.partition_count = partitions or workers * 4
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.partitions = None
+        self.totals = Counter()
+        self.errors = Counter()
+        self.last_progress = time.monotonic()
+
+    @property
+    def key(self):
+        """Identifies what's being sent to who, so we don't resume another."""
+        value = json.dumps([self.kwargs, self.audience], sort_keys=True)
+        return hashlib.sha256(value.encode()).hexdigest()
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return False
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        if state["key"] != self.key:
+            raise CheckpointError(
+                f"{self.checkpoint} is a checkpoint for a different broadcast"
+            )
+        self.partitions = state["partitions"]
+        self.totals = Counter(state["totals"])
+        self.errors = Counter(state["errors"])
+        return True
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        state = {
+            "key": self.key,
+            "partitions": self.partitions,
+            "totals": self.totals,
+            "errors": self.errors,
+        }
+        # replace the file whole, so a crash can't leave it half written
+        with open(f"{self.checkpoint}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{self.checkpoint}.tmp", self.checkpoint)
+
+    def record(self, index, last_id, summary):
+        self.partitions[index]["after"] = last_id
+        self.errors.update(summary.pop("errors"))
+        self.totals.update(summary)
+        if time.monotonic() - self.last_progress >= self.progress_interval:
+            self.report_progress()
+
+    def finish(self, index):
+        self.partitions[index]["done"] = True
+        self.save_checkpoint()
+
+    def report_progress(self):
+        self.last_progress = time.monotonic()
+        self.save_checkpoint()
+        if self.progress is not None:
+            done = sum(1 for p in self.partitions if p["done"])
+            self.progress(
+                f"{self.totals['devices']} devices sent to, "
+                f"{self.totals['success']} succeeded, "
+                f"{self.totals['failure']} failed, "
+                f"{done}/{len(self.partitions)} partitions done"
+            )
+
+    def run(self):
+        """Send the broadcast, returning the totals and errors by code."""
+        if not self.load_checkpoint():
+            self.partitions = [
+                {"start": start, "end": end, "after": None, "done": False}
+                for start, end in partition(self.audience, self.partition_count)
+            ]
+            self.save_checkpoint()
+        pending = [i for i, p in enumerate(self.partitions) if not p["done"]]
+        try:
+            if self.workers > 1:
+                self.run_pool(pending)
+            else:
+                for index in pending:
+                    send_partition(
+                        index,
+                        self.partitions[index],
+                        self.kwargs,
+                        self.audience,
+                        self.record,
+                    )
+                    self.finish(index)
+        finally:
+            self.save_checkpoint()
+        if self.checkpoint:
+            os.remove(self.checkpoint)
+        return dict(self.totals), dict(self.errors)
+
+    def run_pool(self, pending):
+        reports = multiprocessing.Queue()
+        # children must open their own connections rather than share ours
+        connections.close_all()
+        with multiprocessing.Pool(
+            self.workers, initializer=init_worker, initargs=(reports,)
+        ) as pool:
+            # pool workers live as long as the pool, unless they're killed
+            workers = {process.pid for process in multiprocessing.active_children()}
+            results = [
+                pool.apply_async(
+                    run_partition,
+                    (index, self.partitions[index], self.kwargs, self.audience),
+                )
+                for index in pending
+            ]
+            remaining = set(pending)
+            while remaining:
+                try:
+                    kind, report = reports.get(timeout=1)
+                except queue.Empty:
+                    for result in results:
+                        if result.ready() and not result.successful():
+                            # raise the worker's exception
+                            result.get()
+                    alive = {p.pid for p in multiprocessing.active_children()}
+                    if not workers <= alive:
+                        # its partition will never report back
+                        raise BroadcastError(
+                            "A worker process died, run again with the same "
+                            "checkpoint to carry on"
+                        )
+                    continue
+                if kind == "page":
+                    self.record(*report)
+                else:
+                    self.finish(report)
+                    remaining.discard(report)
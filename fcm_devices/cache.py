@@ -0,0 +1,121 @@
+import threading
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import signals
+from .models import Device
+from .settings import app_settings
+from .utils import chunked
+
+
+class UserDeviceCache(object):
+    """
+    Cache each user's active devices as compact `(id, token, type)` tuples.
+
+    Transactional pushes hit the same users over and over, while their devices
+    rarely change, so when `USER_CACHE_TIMEOUT` is set we keep them in Django's
+    cache framework instead of querying for them on every send. Entries are
+    invalidated when devices are created, updated or deactivated, and again
+    once the change commits, and expire after the timeout in case of changes
+    made some other way.
+
+    Hits and misses are counted per process, see `stats`.
+    """
+
+    # the fields we cache, in Device's field order for `Device.from_db`
+    field_names = ("id", "user_id", "active", "type", "token")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def enabled(self):
+        return app_settings.USER_CACHE_TIMEOUT is not None
+
+    @property
+    def cache(self):
+        return caches[app_settings.CACHE_ALIAS]
+
+    def key(self, user_id):
+        return f"fcm_devices:user_devices:{user_id}"
+
+    def get_devices(self, user):
+        """Return the active devices for a user, from the cache where possible."""
+        if not self.enabled:
+            return list(Device.objects.filter(user=user, active=True))
+        key = self.key(user.pk)
+        rows = self.cache.get(key)
+        with self._lock:
+            if rows is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if rows is None:
+            rows = list(
+                Device.objects.filter(user=user, active=True).values_list(
+                    "id", "type", "token"
+                )
+            )
+            self.cache.set(key, rows, app_settings.USER_CACHE_TIMEOUT)
+        # only the fields we cached are loaded, the rest are deferred
+        return [
+            Device.from_db(None, self.field_names, (pk, user.pk, True, _type, token))
+            for pk, _type, token in rows
+        ]
+
+    def invalidate(self, user_ids):
+        """
+        Drop the entries for users, both now and once the current transaction
+        commits, as until then another process can still read and cache the
+        devices as they were.
+        """
+        if self.enabled and user_ids:
+            keys = [self.key(user_id) for user_id in user_ids]
+            self.cache.delete_many(keys)
+            transaction.on_commit(lambda: self.cache.delete_many(keys))
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+user_device_cache = UserDeviceCache()
+
+
+@receiver(signals.device_created, sender=Device)
+@receiver(signals.device_updated, sender=Device)
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def invalidate_device(sender, **kwargs):
+    device = kwargs.get("device") or kwargs["instance"]
+    user_device_cache.invalidate([device.user_id])
+
+
+@receiver(signals.devices_created, sender=Device)
+@receiver(signals.devices_updated, sender=Device)
+def invalidate_devices(sender, devices, **kwargs):
+    user_device_cache.invalidate({device.user_id for device in devices})
+
+
+@receiver(signals.devices_deactivated, sender=Device)
+def invalidate_deactivated_devices(sender, device_ids, **kwargs):
+    if not user_device_cache.enabled:
+        return
+    for chunk in chunked(device_ids, app_settings.DB_BATCH_SIZE):
+        user_device_cache.invalidate(
+            set(Device.objects.filter(id__in=chunk).values_list("user_id", flat=True))
+        )
+
+
+@receiver(signals.devices_pruned, sender=Device)
+def invalidate_pruned_devices(sender, user_ids, **kwargs):
+    user_device_cache.invalidate(set(user_ids))
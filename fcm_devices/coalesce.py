@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+import json
+
+from django.db import transaction
+
+from asgiref.local import Local
+
+from .dedup import deduplicator
+from .fcm import get_fcm_backend
+from .models import Device
+from .outbox import encode_payload
+from .settings import app_settings
+from .utils import chunked, unique_by_token
+
+
+_local = Local()
+
+
+class SendBuffer(object):
+    """
+    Sends held back until the transaction they were made in commits, then
+    flushed with identical payloads merged into multicasts.
+
+    Sends made in a transaction that rolls back are dropped, along with the
+    rest of its `on_commit` callbacks.
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+        # payload -> ({device id: device}, {user id})
+        self.pending = {}
+
+    def add(self, devices=(), user_ids=(), **kwargs):
+        payload = encode_payload(kwargs)
+
+        def committed():
+            pending_devices, pending_user_ids = self.pending.setdefault(
+                payload, ({}, set())
+            )
+            for device in devices:
+                pending_devices.setdefault(device.pk, device)
+            pending_user_ids.update(user_ids)
+
+        transaction.on_commit(committed, using=self.using)
+
+    def flush(self):
+        """
+        Send everything committed so far, each token once per payload,
+        returning a `BulkResult` per multicast sent.
+        """
+        pending, self.pending = self.pending, {}
+        backend = get_fcm_backend()
+        results = []
+        for payload, (devices, user_ids) in pending.items():
+            for chunk in chunked(sorted(user_ids), app_settings.DB_BATCH_SIZE):
+                for device in Device.objects.filter(user_id__in=chunk, active=True):
+                    devices.setdefault(device.pk, device)
+            groups = deduplicator.dedupe(
+                unique_by_token(devices.values()), json.loads(payload)
+            )
+            for kwargs, grouped in groups:
+                results.append(backend.send_bulk(grouped, **kwargs))
+        return results
+
+
+def current_buffer():
+    """The innermost `SendBuffer` in use, if any."""
+    buffers = getattr(_local, "buffers", None)
+    return buffers[-1] if buffers else None
+
+
+@contextmanager
+def coalesce_sends(using=None):
+    """
+    Buffer `send_notification` and `send_notification_to_user` calls made within
+    the block, sending them once the current transaction commits.
+
+    Each user's devices are looked up in one query when flushing, and sends
+    with identical kwargs go out together as multicasts, so notifying many
+    users of the same thing costs a handful of requests. Buffered calls return
+    `None` rather than their responses. Outside a transaction sends are flushed
+    as the block exits.
+    """
+    buffer = SendBuffer(using)
+    if getattr(_local, "buffers", None) is None:
+        _local.buffers = []
+    _local.buffers.append(buffer)
+    try:
+        yield buffer
+    finally:
+        _local.buffers.pop()
+        # runs after the callbacks buffering sends, which were registered first
+        transaction.on_commit(buffer.flush, using=using)
+
+
+class CoalesceSendsMiddleware(object):
+    """Coalesce the sends made while handling each request, see `coalesce_sends`."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with coalesce_sends():
+            return self.get_response(request)
@@ -0,0 +1,78 @@
+import hashlib
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .outbox import encode_payload
+from .settings import app_settings
+
+
+def count_messages(kwargs, count):
+    """A `DEDUP_MERGE` function summarising merged sends, ie - "3 new messages"."""
+    return dict(kwargs, message_body=f"{count} new messages")
+
+
+class Deduplicator(object):
+    """
+    Drop repeats of a notification to a device within `DEDUP_WINDOW` seconds.
+
+    Sends are keyed by device and their `collapse_key`, or their whole payload
+    if they have none, with the window for each kept in Django's cache. If
+    `DEDUP_MERGE` is set, dropped sends are counted instead of forgotten, and
+    the next send to go out once the window has passed is passed through the
+    merge function along with how many it stands for.
+    """
+
+    # how long a count of dropped sends waits for a send to merge into
+    count_timeout = 24 * 60 * 60
+
+    @property
+    def enabled(self):
+        return app_settings.DEDUP_WINDOW is not None
+
+    @property
+    def cache(self):
+        return caches[app_settings.CACHE_ALIAS]
+
+    def get_merge(self):
+        if app_settings.DEDUP_MERGE is None:
+            return None
+        return import_string(app_settings.DEDUP_MERGE)
+
+    def key(self, device, kwargs):
+        collapse_key = kwargs.get("collapse_key")
+        value = encode_payload(kwargs) if collapse_key is None else collapse_key
+        digest = hashlib.sha256(value.encode()).hexdigest()
+        return f"fcm_devices:dedup:{device.pk}:{digest}"
+
+    def dedupe(self, devices, kwargs):
+        """
+        Return the sends to make for a notification to `devices`, as
+        `(kwargs, devices)` pairs, leaving out the devices it's a repeat for.
+        """
+        if not self.enabled:
+            return [(kwargs, list(devices))]
+        merge = self.get_merge()
+        # devices grouped by the number of earlier sends merged into theirs
+        groups = {}
+        for device in devices:
+            key = self.key(device, kwargs)
+            if self.cache.add(key, True, app_settings.DEDUP_WINDOW):
+                merged = 0
+                if merge is not None:
+                    merged = self.cache.get(f"{key}:merged", 0)
+                    if merged:
+                        self.cache.delete(f"{key}:merged")
+                groups.setdefault(merged, []).append(device)
+            elif merge is not None:
+                try:
+                    self.cache.incr(f"{key}:merged")
+                except ValueError:
+                    self.cache.set(f"{key}:merged", 1, self.count_timeout)
+        return [
+            (merge(kwargs, merged + 1) if merged else kwargs, grouped)
+            for merged, grouped in groups.items()
+        ]
+
+
+deduplicator = Deduplicator()
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from .settings import app_settings
+
+
+class SendPool(object):
+    """
+    A bounded thread pool, reused between calls, for dispatching sends in
+    parallel.
+
+    It's sized by `SEND_WORKERS` and, like the FCM client pools, rebuilt in a
+    forked child and whenever an `FCM_DEVICES_*` setting changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # a forked child doesn't inherit the parent's worker threads
+                self._executor = ThreadPoolExecutor(
+                    max_workers=app_settings.SEND_WORKERS,
+                    thread_name_prefix="fcm-devices",
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def reset(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=False)
+
+    def map(self, fn, items):
+        """
+        Call `fn` on each of `items` in the pool, returning the results in the
+        order of `items`.
+
+        An exception raised by a call is returned in place of its result rather
+        than aborting the others.
+        """
+        executor = self.get_executor()
+        futures = [executor.submit(self._call, fn, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    @staticmethod
+    def _call(fn, item):
+        try:
+            return fn(item)
+        finally:
+            # workers outlive requests, so tidy up their database connections
+            # the way Django does at the end of each one
+            close_old_connections()
+
+
+send_pool = SendPool()
+
+
+@receiver(setting_changed)
+def reset_send_pool(setting, **kwargs):
+    if setting.startswith(f"{app_settings.prefix}_"):
+        send_pool.reset()
@@ -1,10 +1,48 @@
+import asyncio
+from collections import Counter, namedtuple
+from functools import lru_cache, partial
+import json
+import math
+import os
+import random
+import socket
+import threading
+import time
+import weakref
+
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.module_loading import import_string
 
+from asgiref.sync import sync_to_async
 from pyfcm import FCMNotification
+from pyfcm.errors import (
+    AuthenticationError,
+    FCMNotRegisteredError,
+    FCMServerError,
+    InvalidDataError,
+)
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 
+from .dispatch import send_pool
+from .metrics import get_metrics
+from .models import Device, hash_token
+from .ratelimit import parse_retry_after, rate_limiters
 from .settings import app_settings
-from .signals import device_updated
+from .signals import device_updated, devices_deactivated, devices_updated
+from .utils import chunked
+
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
 
 
 # categorise common errors in terms of what we"ll do
@@ -12,37 +50,763 @@ unrecoverable_errors = set(
     ["MissingRegistration", "InvalidRegistration", "NotRegistered"]
 )
 configuration_errors = set(["MismatchSenderId"])
+# transient errors, worth retrying after a short wait
+retryable_errors = set(["Unavailable", "InternalServerError"])
+retryable_exceptions = (FCMServerError, requests.ConnectionError, requests.Timeout)
+async_retryable_exceptions = (FCMServerError, asyncio.TimeoutError)
+if aiohttp is not None:
+    async_retryable_exceptions += (aiohttp.ClientError,)
+# signs we're sending faster than FCM would like
+throttling_errors = set(
+    ["DeviceMessageRateExceeded", "TopicsMessageRateExceeded", "Unavailable"]
+)
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter which turns on TCP keep-alive for its pooled connections."""
+
+    socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class PacedFCMNotification(FCMNotification):
+    """
+    pyfcm client timing each request it makes, and pacing them with the shared
+    `RateLimiter` for its API key, if `RATE_LIMIT` is set.
+
+    A `Retry-After` from FCM then holds back requests from every thread rather
+    than just this one, and a 429 without one slows us down. Only the requests
+    themselves are timed, not waits for the limiter or a `Retry-After`.
+    """
+
+    def do_request(self, payload, timeout):
+        limiter = rate_limiters.get(self._FCM_API_KEY)
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            with get_metrics().timer("fcm.send.latency"):
+                response = self.requests_session.post(
+                    self.FCM_END_POINT, data=payload, timeout=timeout
+                )
+            retry_after = parse_retry_after(response.headers)
+            if not retry_after:
+                break
+            if limiter is not None:
+                limiter.pause(retry_after)
+            else:
+                time.sleep(retry_after)
+        if limiter is not None and response.status_code == 429:
+            limiter.slow_down()
+        return response
+
+
+class FCMClientPool(object):
+    """
+    Hand out pyfcm clients sharing one connection pool per process and API key.
+
+    pyfcm keeps the responses of the last request on the client instance, so a
+    client can't safely be shared between threads. Instead each thread gets its
+    own client, but all of them are mounted on the same `HTTPAdapter` whose
+    urllib3 pool is thread-safe, meaning connections (and TLS sessions) to FCM
+    are reused across sends rather than set up for every device.
+
+    The pool is rebuilt in a forked child, so sockets are never shared with the
+    parent process, and whenever an `FCM_DEVICES_*` setting changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._adapters = {}
+        self._local = threading.local()
+
+    def reset(self):
+        with self._lock:
+            adapters = list(self._adapters.values())
+            self._reset()
+        for adapter in adapters:
+            adapter.close()
+
+    def get_adapter(self, api_key):
+        with self._lock:
+            adapter = self._adapters.get(api_key)
+            if adapter is None:
+                adapter = self._adapters[api_key] = self.build_adapter()
+            return adapter
+
+    def build_adapter(self):
+        # mirror the retry behaviour pyfcm configures on its own adapters
+        retries = Retry(
+            backoff_factor=1,
+            status_forcelist=[502, 503],
+            method_whitelist=(Retry.DEFAULT_METHOD_WHITELIST | frozenset(["POST"])),
+        )
+        adapter_class = (
+            KeepAliveHTTPAdapter if app_settings.HTTP_KEEPALIVE else HTTPAdapter
+        )
+        return adapter_class(
+            pool_maxsize=app_settings.HTTP_POOL_SIZE, max_retries=retries
+        )
+
+    def get_client(self, api_key):
+        if self._pid != os.getpid():
+            # we've been forked, don't touch our parent's sockets
+            self._reset()
+        local = self._local
+        if not hasattr(local, "clients"):
+            local.clients = {}
+        client = local.clients.get(api_key)
+        if client is None:
+            client = local.clients[api_key] = PacedFCMNotification(
+                api_key=api_key, adapter=self.get_adapter(api_key)
+            )
+            if app_settings.ENDPOINT:
+                client.FCM_END_POINT = app_settings.ENDPOINT
+        return client
+
+
+AsyncClient = namedtuple("AsyncClient", ("generation", "session", "semaphore"))
+
+
+class AsyncFCMClientPool(object):
+    """
+    Share an aiohttp session, and a semaphore capping requests in flight,
+    between async sends.
+
+    Both are bound to the event loop they're created in, so we keep one of each
+    per loop. A client created before an `FCM_DEVICES_*` setting changed is
+    closed and replaced the next time it's asked for.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self._clients = weakref.WeakKeyDictionary()
+
+    def reset(self):
+        self.generation += 1
+
+    async def get_client(self):
+        loop = asyncio.get_event_loop()
+        client = self._clients.get(loop)
+        if client is not None and (
+            client.generation != self.generation or client.session.closed
+        ):
+            await client.session.close()
+            client = None
+        if client is None:
+            if aiohttp is None:
+                raise ImproperlyConfigured(
+                    "aiohttp is required for async sends, "
+                    "install django-fcm-devices[async]"
+                )
+            limit = app_settings.ASYNC_MAX_CONCURRENCY
+            client = self._clients[loop] = AsyncClient(
+                generation=self.generation,
+                session=aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=limit)
+                ),
+                semaphore=asyncio.Semaphore(limit),
+            )
+        return client
+
+    async def close(self):
+        """Close the client for the running event loop, if there is one."""
+        client = self._clients.pop(asyncio.get_event_loop(), None)
+        if client is not None:
+            await client.session.close()
+
+
+client_pool = FCMClientPool()
+async_client_pool = AsyncFCMClientPool()
+
+
+@receiver(setting_changed)
+def reset_client_pool(setting, **kwargs):
+    if setting.startswith(f"{app_settings.prefix}_"):
+        client_pool.reset()
+        async_client_pool.reset()
+        get_fcm_backend.cache_clear()
+
+
+class BulkResult(object):
+    """
+    Aggregate outcome of sending one notification to many devices.
+
+    `results` pairs each device with the entry FCM returned for its token, in
+    the order the devices were sent to.
+    """
+
+    def __init__(self):
+        self.multicast_ids = []
+        self.success = 0
+        self.failure = 0
+        self.canonical_ids = 0
+        self.results = []
+        self.deactivated = []
+        self.exceptions = []
+        self.error_counts = Counter()
+
+    def add(self, devices, response):
+        self.multicast_ids.extend(response.get("multicast_ids", []))
+        self.success += int(response["success"])
+        self.failure += int(response["failure"])
+        self.canonical_ids += int(response.get("canonical_ids", 0))
+        results = response.get("results", [])
+        self.results.extend(zip(devices, results))
+        self.error_counts.update(r["error"] for r in results if "error" in r)
+
+    def merge(self, other):
+        """
+        Add the counts, deactivations and exceptions of another result to this
+        one, but not its per-device `results`.
+        """
+        self.multicast_ids.extend(other.multicast_ids)
+        self.success += other.success
+        self.failure += other.failure
+        self.canonical_ids += other.canonical_ids
+        self.deactivated.extend(other.deactivated)
+        self.exceptions.extend(other.exceptions)
+        self.error_counts.update(other.error_counts)
+
+    @property
+    def exhausted(self):
+        """Devices still hitting transient errors once out of retries."""
+        return [
+            device
+            for device, result in self.results
+            if result.get("error") in retryable_errors
+        ]
+
+
+class RetryBatch(object):
+    """
+    Track sending to a batch of devices over several attempts, where each
+    attempt only sends to the devices that hit `retryable_errors` last time.
+    """
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.pending = list(range(len(devices)))
+        self.results = [{} for _ in devices]
+        self.responses = []
+
+    @property
+    def pending_devices(self):
+        return [self.devices[i] for i in self.pending]
+
+    def update(self, response):
+        self.responses.append(response)
+        pending = []
+        for i, result in zip(self.pending, response.get("results", [])):
+            self.results[i] = result
+            if result.get("error") in retryable_errors:
+                pending.append(i)
+        self.pending = pending
+
+    def response(self):
+        """Combine the responses for every attempt into one, in device order."""
+        if not self.responses:
+            raise ValueError("No responses to combine, nothing was sent")
+        if len(self.responses) == 1:
+            return self.responses[0]
+        failure = sum(1 for result in self.results if "error" in result)
+        return {
+            "multicast_ids": [
+                i for response in self.responses for i in response["multicast_ids"]
+            ],
+            "success": len(self.results) - failure,
+            "failure": failure,
+            "canonical_ids": sum(
+                response.get("canonical_ids", 0) for response in self.responses
+            ),
+            "results": self.results,
+            "topic_message_id": None,
+        }
 
 
 class FCMBackend(object):
-    """You can override this class to customise sending of notifications."""
+    """
+    You can override this class to customise sending of notifications.
+
+    One instance is shared by all sends in a process, see `get_fcm_backend`.
+    """
+
+    # FCM only accepts this many registration tokens per multicast request
+    max_recipients = FCMNotification.FCM_MAX_RECIPIENTS
+
+    def get_client(self):
+        return client_pool.get_client(app_settings.API_KEY)
+
+    def get_rate_limiter(self):
+        return rate_limiters.get(app_settings.API_KEY)
 
     def send_notification(self, device, **kwargs):
-        push_service = FCMNotification(api_key=app_settings.API_KEY)
-        result = push_service.notify_single_device(
+        result = self.retry(
+            lambda devices: self.send_single(device, **kwargs), [device]
+        )
+        self.update_device_on_error(device, result)
+        return result
+
+    def send_notifications(self, devices, **kwargs):
+        """
+        Send a notification to each device with its own request, in parallel
+        using `send_pool`, and return the responses in device order, with any
+        exception raised in place of its response.
+
+        Only the requests are made in the pool's threads. Errors are acted
+        upon in the caller's thread once all are done, with one
+        `update_devices_on_results` for them all, so database writes follow
+        the caller's transaction and don't contend with each other.
+        """
+
+        def send(device):
+            return self.retry(
+                lambda devices: self.send_single(device, **kwargs), [device]
+            )
+
+        responses = send_pool.map(send, devices)
+        results = [
+            (device, result)
+            for device, response in zip(devices, responses)
+            if not isinstance(response, Exception)
+            for result in response.get("results", [])
+        ]
+        deactivated = set(self.update_devices_on_results(results))
+        for device in devices:
+            if device.id in deactivated:
+                device.active = False
+                device_updated.send(sender=device.__class__, device=device)
+        return responses
+
+    def send_single(self, device, **kwargs):
+        response = self.get_client().notify_single_device(
             registration_id=device.token,
             **kwargs,
         )
-        self.update_device_on_error(device, result)
+        self.throttle_on_errors(response)
+        self.record_response([device], response)
+        return response
+
+    def send_bulk(self, devices, **kwargs):
+        """
+        Send a notification to many devices, using one multicast request per
+        `max_recipients` devices, and return a `BulkResult`.
+
+        If `SEND_WORKERS` is set, requests are made in parallel. Either way any
+        exception raised by one is collected in `BulkResult.exceptions` rather
+        than aborting the others.
+
+        Errors are acted upon once all requests have been made, so that
+        devices are deactivated with as few queries as possible. Should that
+        raise for a configuration error, the `BulkResult` so far is attached to
+        the exception as `result`.
+        """
+        result = BulkResult()
+        send_multicast = partial(self.retry, partial(self.send_multicast, **kwargs))
+        workers = app_settings.SEND_WORKERS
+        chunks = chunked(devices, self.max_recipients)
+        for window in chunked(chunks, workers or 1):
+            if workers:
+                responses = send_pool.map(send_multicast, window)
+            else:
+                responses = self.send_each(send_multicast, window)
+            if self.add_responses(result, window, responses):
+                # every other request would fail the same way
+                break
+        return self.act_on_results(result)
+
+    def add_responses(self, result, chunks, responses):
+        """
+        Add the response, or exception, for each chunk to a `BulkResult`,
+        returning whether any hit `configuration_errors`.
+        """
+        misconfigured = False
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, Exception):
+                result.exceptions.append((chunk, response))
+                continue
+            result.add(chunk, response)
+            misconfigured = misconfigured or any(
+                r.get("error") in configuration_errors
+                for r in response.get("results", [])
+            )
+        return misconfigured
+
+    def act_on_results(self, result):
+        """Act on the errors in a `BulkResult` once it's complete."""
+        try:
+            result.deactivated = self.update_devices_on_results(result.results)
+        except ImproperlyConfigured as e:
+            # let the caller see what was sent before giving up
+            e.result = result
+            raise
         return result
 
+    def send_each(self, send, chunks):
+        """
+        Call `send` on each chunk in turn, returning any exception raised in
+        place of its response as `send_pool.map` does.
+        """
+        responses = []
+        for chunk in chunks:
+            try:
+                responses.append(send(chunk))
+            except Exception as e:
+                responses.append(e)
+        return responses
+
+    def send_multicast(self, devices, **kwargs):
+        response = self.get_client().notify_multiple_devices(
+            registration_ids=[device.token for device in devices],
+            **kwargs,
+        )
+        self.throttle_on_errors(response)
+        self.record_response(devices, response)
+        return response
+
+    def retry(self, send, devices):
+        """
+        Call `send(devices)`, then resend to only the devices which hit
+        `retryable_errors`, or all of them if it raised one of
+        `retryable_exceptions`, until `RETRY_ATTEMPTS` attempts have been made.
+
+        Returns one response for all attempts. Devices which never succeeded
+        keep their last transient error, see `BulkResult.exhausted`.
+        """
+        # at least one, or nothing would be sent at all
+        attempts = max(1, app_settings.RETRY_ATTEMPTS)
+        batch = RetryBatch(devices)
+        metrics = get_metrics()
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(self.backoff(attempt))
+                metrics.increment("fcm.send.retries", len(batch.pending))
+            try:
+                batch.update(send(batch.pending_devices))
+            except retryable_exceptions as e:
+                metrics.increment("fcm.send.exceptions", exception=type(e).__name__)
+                if attempt + 1 == attempts and not batch.responses:
+                    raise
+                continue
+            if not batch.pending:
+                break
+        return batch.response()
+
+    def backoff(self, attempt):
+        """Seconds to wait before a retry, exponential with full jitter."""
+        cap = min(
+            app_settings.RETRY_BACKOFF_MAX,
+            app_settings.RETRY_BACKOFF * 2 ** (attempt - 1),
+        )
+        return random.uniform(0, cap)
+
+    def throttle_on_errors(self, response):
+        """Slow all sends down if any results say we're sending too fast."""
+        limiter = self.get_rate_limiter()
+        if limiter is not None and any(
+            result.get("error") in throttling_errors
+            for result in response.get("results", [])
+        ):
+            limiter.slow_down()
+
+    def record_response(self, devices, response):
+        """Record metrics for a response from FCM, see `MetricsSink`."""
+        metrics = get_metrics()
+        metrics.observe("fcm.send.batch_size", len(devices))
+        metrics.increment("fcm.send.success", response.get("success", 0))
+        errors = Counter(
+            result["error"]
+            for result in response.get("results", [])
+            if "error" in result
+        )
+        for error, count in errors.items():
+            metrics.increment("fcm.send.failure", count, error=error)
+
+    async def asend_notification(self, device, **kwargs):
+        """Async `send_notification`, run in a thread unless overridden."""
+        return await sync_to_async(self.send_notification)(device, **kwargs)
+
+    async def asend_bulk(self, devices, **kwargs):
+        """Async `send_bulk`, run in a thread unless overridden."""
+        return await sync_to_async(self.send_bulk)(devices, **kwargs)
+
     def update_device_on_error(self, device, result):
         """
         If a device fails to be sent a notification due to an unrecoverable
         issue we want to ensure we don't try again.
 
-        See `unrecoverable_errors` for which we act upon.
+        See `unrecoverable_errors` for which we act upon, and
+        `update_devices_on_results` for what happens to canonical ids.
         """
-        if result["failure"] > 0:
-            if result["results"][0]["error"] in unrecoverable_errors:
+        if result["failure"] > 0 or result.get("canonical_ids"):
+            results = [(device, r) for r in result["results"]]
+            if self.update_devices_on_results(results):
                 device.active = False
-                device.save(update_fields=("active", "updated_at"))
                 device_updated.send(sender=device.__class__, device=device)
-            elif result["results"][0]["error"] in configuration_errors:
-                raise ImproperlyConfigured(
-                    f"FCM configuration problem sending to device {device.id}: "
-                    f"{result['results'][0]['error']}"
+
+    def update_devices_on_results(self, results):
+        """
+        Act on the FCM results for a batch of `(device, result)` pairs.
+
+        Devices hitting `unrecoverable_errors` are deactivated in bulk and
+        their ids returned. Devices given a canonical registration id have
+        their token rewritten, see `update_canonical_tokens`. If any hit
+        `configuration_errors` we raise once those updates are done.
+        """
+        unrecoverable = []
+        canonical = []
+        misconfigured = None
+        for device, result in results:
+            error = result.get("error")
+            if error in unrecoverable_errors:
+                unrecoverable.append(device.id)
+            elif error in configuration_errors and misconfigured is None:
+                misconfigured = (device, error)
+            elif result.get("registration_id"):
+                canonical.append((device, result["registration_id"]))
+        if canonical:
+            unrecoverable.extend(self.update_canonical_tokens(canonical))
+        if unrecoverable:
+            self.deactivate_devices(unrecoverable)
+        if misconfigured:
+            device, error = misconfigured
+            raise ImproperlyConfigured(
+                f"FCM configuration problem sending to device {device.id}: {error}"
+            )
+        return unrecoverable
+
+    def update_canonical_tokens(self, canonical):
+        """
+        Rewrite the tokens of devices FCM gave a canonical registration id for,
+        given as `(device, canonical_id)` pairs, so we stop sending to the old.
+
+        Tokens are rewritten with one `bulk_update` per `DB_BATCH_SIZE` devices
+        and a single `devices_updated` signal fired for them all. Where the
+        user already has a device with the canonical token, the stale one is a
+        duplicate, and its id is returned for deactivation instead.
+        """
+        device_ids = {device.id for device, _ in canonical}
+        user_ids = {}
+        existing = set()
+        for chunk in chunked(canonical, app_settings.DB_BATCH_SIZE):
+            user_ids.update(
+                Device.objects.filter(
+                    id__in=[device.id for device, _ in chunk]
+                ).values_list("id", "user_id")
+            )
+            existing.update(
+                (user_id, token)
+                for pk, user_id, token in Device.objects.by_tokens(
+                    [token for _, token in chunk]
+                ).values_list("id", "user_id", "token")
+                if pk not in device_ids
+            )
+
+        now = timezone.now()
+        rewrites = []
+        duplicates = []
+        for device, token in canonical:
+            key = (user_ids.get(device.id), token)
+            if key[0] is None:
+                # deleted since we sent to it
+                continue
+            if key in existing:
+                duplicates.append(device.id)
+                continue
+            existing.add(key)
+            rewrites.append((device, key[0], token))
+
+        updated = []
+        for chunk in chunked(rewrites, app_settings.DB_BATCH_SIZE):
+            written, conflicts = self.write_canonical_tokens(chunk, now)
+            duplicates.extend(conflicts)
+            for device, user_id, token in written:
+                device.user_id = user_id
+                device.token = token
+                device.token_hash = hash_token(token)
+                device.updated_at = now
+                updated.append(device)
+        get_metrics().increment("fcm.devices.canonicalised", len(updated))
+        if updated:
+            devices_updated.send(sender=Device, devices=updated)
+        return duplicates
+
+    def write_canonical_tokens(self, rewrites, now):
+        """
+        Write `(device, user_id, token)` rewrites with one `bulk_update`,
+        returning those written and the ids of devices whose canonical token
+        turned out to be taken, without touching the device instances.
+
+        Should a canonical token have been registered while we were busy, the
+        rewrites are written one at a time to find out which.
+        """
+        rows = [
+            Device(
+                id=device.id, token=token, token_hash=hash_token(token), updated_at=now
+            )
+            for device, _, token in rewrites
+        ]
+        fields = ["token", "token_hash", "updated_at"]
+        try:
+            with transaction.atomic():
+                Device.objects.bulk_update(rows, fields)
+            return rewrites, []
+        except IntegrityError:
+            pass
+        written = []
+        conflicts = []
+        for rewrite, row in zip(rewrites, rows):
+            try:
+                with transaction.atomic():
+                    Device.objects.bulk_update([row], fields)
+            except IntegrityError:
+                conflicts.append(row.id)
+            else:
+                written.append(rewrite)
+        return written, conflicts
+
+    def deactivate_devices(self, device_ids):
+        """
+        Deactivate devices using one UPDATE per `DB_BATCH_SIZE` ids and
+        fire a single `devices_deactivated` signal for them all.
+        """
+        now = timezone.now()
+        for chunk in chunked(device_ids, app_settings.DB_BATCH_SIZE):
+            Device.objects.filter(id__in=chunk).update(active=False, updated_at=now)
+        get_metrics().increment("fcm.devices.deactivated", len(device_ids))
+        devices_deactivated.send(sender=Device, device_ids=device_ids)
+
+
+class AsyncFCMBackend(FCMBackend):
+    """
+    FCM backend sending natively with asyncio for `asend_notification` and
+    `asend_bulk`.
+
+    Requests share one aiohttp session per event loop, and at most
+    `ASYNC_MAX_CONCURRENCY` are in flight at once. Errors are acted on the same
+    way as for sync sends, and sync sends still work as per `FCMBackend`.
+    """
+
+    async def asend_notification(self, device, **kwargs):
+        response = await self.aretry(partial(self.asend_multicast, **kwargs), [device])
+        # acting on errors needs the database, so only leave the loop for it
+        # when there's something to act on
+        if response["failure"] > 0 or response.get("canonical_ids"):
+            await sync_to_async(self.update_device_on_error)(device, response)
+        return response
+
+    async def asend_bulk(self, devices, **kwargs):
+        chunks = list(chunked(devices, self.max_recipients))
+        # as for sync sends, one failing request doesn't abort the others
+        responses = await asyncio.gather(
+            *[
+                self.aretry(partial(self.asend_multicast, **kwargs), chunk)
+                for chunk in chunks
+            ],
+            return_exceptions=True,
+        )
+        for response in responses:
+            if isinstance(response, BaseException) and not isinstance(
+                response, Exception
+            ):
+                # such as being cancelled, which is no failure to send
+                raise response
+        result = BulkResult()
+        self.add_responses(result, chunks, responses)
+        return await sync_to_async(self.act_on_results)(result)
+
+    async def aretry(self, send, devices):
+        """Async version of `FCMBackend.retry`, also retrying aiohttp errors."""
+        attempts = max(1, app_settings.RETRY_ATTEMPTS)
+        batch = RetryBatch(devices)
+        metrics = get_metrics()
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(self.backoff(attempt))
+                metrics.increment("fcm.send.retries", len(batch.pending))
+            try:
+                batch.update(await send(batch.pending_devices))
+            except async_retryable_exceptions as e:
+                metrics.increment("fcm.send.exceptions", exception=type(e).__name__)
+                if attempt + 1 == attempts and not batch.responses:
+                    raise
+                continue
+            if not batch.pending:
+                break
+        return batch.response()
+
+    async def asend_multicast(self, devices, timeout=5, extra_kwargs=None, **kwargs):
+        # the sync client knows how to build payloads and headers
+        fcm = self.get_client()
+        payload = fcm.parse_payload(
+            registration_ids=[device.token for device in devices],
+            **kwargs,
+            **(extra_kwargs or {}),
+        )
+        client = await async_client_pool.get_client()
+        limiter = self.get_rate_limiter()
+        while True:
+            if limiter is not None:
+                await limiter.aacquire()
+            async with client.semaphore:
+                with get_metrics().timer("fcm.send.latency"):
+                    async with client.session.post(
+                        fcm.FCM_END_POINT,
+                        data=payload,
+                        headers=fcm.request_headers(),
+                        timeout=aiohttp.ClientTimeout(total=timeout),
+                    ) as response:
+                        body = await response.text()
+            # honour Retry-After as pyfcm does, without holding our slot
+            retry_after = parse_retry_after(response.headers)
+            if not retry_after:
+                break
+            if limiter is not None:
+                limiter.pause(retry_after)
+            else:
+                await asyncio.sleep(retry_after)
+        if limiter is not None and response.status == 429:
+            limiter.slow_down()
+        response = self.parse_response(response.status, body)
+        self.throttle_on_errors(response)
+        self.record_response(devices, response)
+        return response
+
+    def parse_response(self, status, body):
+        """Parse a response from FCM into the same structure pyfcm returns."""
+        if status == 200:
+            if not body:
+                raise FCMServerError(
+                    "FCM server connection error, the response is empty"
                 )
+            parsed = json.loads(body)
+            multicast_id = parsed.get("multicast_id")
+            message_id = parsed.get("message_id")
+            return {
+                "multicast_ids": [multicast_id] if multicast_id else [],
+                "success": 1 if message_id else parsed.get("success", 0),
+                "failure": parsed.get("failure", 0),
+                "canonical_ids": parsed.get("canonical_ids", 0),
+                "results": parsed.get("results", []),
+                "topic_message_id": message_id,
+            }
+        elif status == 401:
+            raise AuthenticationError(
+                "There was an error authenticating the sender account"
+            )
+        elif status == 400:
+            raise InvalidDataError(body)
+        elif status == 404:
+            raise FCMNotRegisteredError("Token not registered")
+        raise FCMServerError("FCM server is temporarily unavailable")
 
 
 class ConsoleFCMBackend(FCMBackend):
@@ -53,8 +817,114 @@ class ConsoleFCMBackend(FCMBackend):
         # this is a partial response, but the part our sending code will be looking for
         return {"success": 1, "failure": 0}
 
+    def send_notifications(self, devices, **kwargs):
+        return [self.send_notification(device, **kwargs) for device in devices]
+
+    def send_multicast(self, devices, **kwargs):
+        print(f"Push to {len(devices)} devices\nPyFCM kwargs: {kwargs}\n")
+        return {
+            "success": len(devices),
+            "failure": 0,
+            "results": [{"message_id": "console"} for _ in devices],
+        }
+
+
+class FakeFCMBackend(FCMBackend):
+    """
+    FCM backend simulating FCM in-process, for load testing and staging.
+
+    No requests are made, but everything else about sending is as for
+    `FCMBackend`, so retries, rate limiting and deactivation are exercised.
+    Each simulated request takes a log-normal latency around `FAKE_LATENCY`
+    seconds. Tokens fail at random per `FAKE_ERROR_RATES`, ie -
+    `{"NotRegistered": 0.01, "Unavailable": 0.001}`, and successful ones get a
+    canonical id per `FAKE_CANONICAL_RATE`.
+
+    What was sent is counted per process, see `stats`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._random = random.Random(app_settings.FAKE_SEED)
+        self.reset_stats()
+
+    def send_single(self, device, **kwargs):
+        return self.send_multicast([device], **kwargs)
+
+    def send_multicast(self, devices, **kwargs):
+        limiter = self.get_rate_limiter()
+        if limiter is not None:
+            limiter.acquire()
+        with get_metrics().timer("fcm.send.latency"):
+            response = self.simulate(devices)
+        self.throttle_on_errors(response)
+        self.record_response(devices, response)
+        return response
 
+    def simulate(self, devices):
+        """Wait as long as FCM might, then respond as it might, to a multicast."""
+        with self._lock:
+            latency = self.latency()
+            self.requests += 1
+            multicast_id = self.requests
+            results = [self.simulate_result(multicast_id, d.token) for d in devices]
+        if latency:
+            time.sleep(latency)
+        failure = sum(1 for result in results if "error" in result)
+        canonical_ids = sum(1 for result in results if "registration_id" in result)
+        with self._lock:
+            self.counts["messages"] += len(results)
+            self.counts["success"] += len(results) - failure
+            self.counts["canonical_ids"] += canonical_ids
+            self.errors.update(r["error"] for r in results if "error" in r)
+        return {
+            "multicast_ids": [multicast_id],
+            "success": len(results) - failure,
+            "failure": failure,
+            "canonical_ids": canonical_ids,
+            "results": results,
+            "topic_message_id": None,
+        }
+
+    def latency(self):
+        median = app_settings.FAKE_LATENCY
+        if not median:
+            return 0
+        return self._random.lognormvariate(
+            math.log(median), app_settings.FAKE_LATENCY_SIGMA
+        )
+
+    def simulate_result(self, multicast_id, token):
+        roll = self._random.random()
+        for error, rate in app_settings.FAKE_ERROR_RATES.items():
+            if roll < rate:
+                return {"error": error}
+            roll -= rate
+        result = {"message_id": f"0:{multicast_id}:{token[:10]}"}
+        if self._random.random() < app_settings.FAKE_CANONICAL_RATE:
+            result["registration_id"] = f"canonical-{token}"
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, requests=self.requests, errors=dict(self.errors))
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = 0
+            self.counts = Counter(messages=0, success=0, canonical_ids=0)
+            self.errors = Counter()
+
+
+@lru_cache(maxsize=None)
 def get_fcm_backend():
+    """
+    Return the configured backend.
+
+    It's built once per process and shared between threads, so a backend can
+    hold expensive state across calls but must be thread-safe. It's rebuilt
+    whenever an `FCM_DEVICES_*` setting changes.
+    """
     cls = app_settings.BACKEND_CLASS
     if cls is None:
         # default to console to avoid accidental push notifications
@@ -0,0 +1,89 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fcm_devices.broadcast import Broadcast, BroadcastError
+from fcm_devices.models import Device
+
+
+class Command(BaseCommand):
+    help = (
+        "Send a notification to every device matching the given filters, split "
+        "across a pool of worker processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "payload",
+            help='JSON kwargs to send with, ie - \'{"message_body": "Hello"}\'',
+        )
+        parser.add_argument(
+            "--type",
+            action="append",
+            dest="types",
+            choices=[value for value, _ in Device._meta.get_field("type").choices],
+            help="Only send to devices of this type, can be given more than once",
+        )
+        parser.add_argument(
+            "--user-ids-file",
+            help="Only send to the devices of users whose ids are in this file, one per line",
+        )
+        parser.add_argument(
+            "--include-inactive",
+            action="store_true",
+            help="Send to inactive devices too",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=1, help="Processes to send with"
+        )
+        parser.add_argument(
+            "--partitions",
+            type=int,
+            help="Partitions to split devices into, defaults to four per worker",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="File to save progress to, and to resume from if it exists",
+        )
+        parser.add_argument(
+            "--progress-interval",
+            type=float,
+            default=10,
+            help="Seconds between progress updates",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            kwargs = json.loads(options["payload"])
+        except ValueError as e:
+            raise CommandError(f"The payload isn't valid JSON: {e}")
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        if options["partitions"] is not None and options["partitions"] < 1:
+            raise CommandError("--partitions must be at least 1")
+        broadcast = Broadcast(
+            kwargs,
+            {
+                "types": options["types"],
+                "user_ids_file": options["user_ids_file"],
+                "include_inactive": options["include_inactive"],
+            },
+            workers=options["workers"],
+            partitions=options["partitions"],
+            checkpoint=options["checkpoint"],
+            progress=self.stdout.write,
+            progress_interval=options["progress_interval"],
+        )
+        try:
+            totals, errors = broadcast.run()
+        except BroadcastError as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            f"Sent to {totals.get('devices', 0)} devices: "
+            f"{totals.get('success', 0)} succeeded, "
+            f"{totals.get('failure', 0)} failed, "
+            f"{totals.get('deactivated', 0)} deactivated, "
+            f"{totals.get('exceptions', 0)} not sent due to exceptions"
+        )
+        for error, count in sorted(errors.items()):
+            self.stdout.write(f"  {error}: {count}")
@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fcm_devices import outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Send notifications queued with `enqueue_notification`. Any number of "
+        "workers can run at once, each claiming different rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Rows to claim and send at a time",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait before checking again when the outbox is empty",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the outbox is empty, rather than waiting for more",
+        )
+
+    def handle(self, *args, batch_size, interval, once, **options):
+        while True:
+            counts = outbox.drain(batch_size)
+            if counts:
+                self.stdout.write(
+                    ", ".join(
+                        f"{status} {count}" for status, count in sorted(counts.items())
+                    )
+                )
+            elif once:
+                return
+            else:
+                time.sleep(interval)
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from fcm_devices.prune import prunable, prune_devices
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete, or deactivate, inactive devices and devices that haven't been "
+        "updated in a while, a range of ids at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--inactive-days",
+            type=int,
+            help="Prune inactive devices not updated in this many days",
+        )
+        parser.add_argument(
+            "--stale-days",
+            type=int,
+            help="Prune any device not updated in this many days",
+        )
+        parser.add_argument(
+            "--deactivate",
+            action="store_true",
+            help="Deactivate stale devices rather than deleting them",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Width of the id ranges pruned in each transaction",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to wait after each range that pruned something",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Count the devices that would be pruned and exit",
+        )
+
+    def handle(
+        self,
+        *args,
+        inactive_days,
+        stale_days,
+        deactivate,
+        chunk_size,
+        sleep,
+        dry_run,
+        **options,
+    ):
+        if inactive_days is None and stale_days is None:
+            raise CommandError("Give --inactive-days, --stale-days or both")
+        if deactivate and stale_days is None:
+            raise CommandError("--deactivate only applies to --stale-days")
+        action = "deactivate" if deactivate else "delete"
+        if dry_run:
+            count = prunable(inactive_days, stale_days, not deactivate).count()
+            self.stdout.write(f"Would {action} {count} devices")
+            return
+        count = prune_devices(
+            inactive_days,
+            stale_days,
+            delete=not deactivate,
+            chunk_size=chunk_size,
+            pause=sleep,
+            progress=lambda pruned: self.stdout.write(
+                f"{action.capitalize()}d {pruned} devices so far"
+            ),
+        )
+        self.stdout.write(f"{action.capitalize()}d {count} devices")
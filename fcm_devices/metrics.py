@@ -0,0 +1,140 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+import logging
+import math
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .settings import app_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of some sorted values."""
+    if not values:
+        return None
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+class MetricsSink(object):
+    """
+    Where the metrics we record go, which by default is nowhere.
+
+    Subclass this to send them to your metrics system. Metrics are named like
+    "fcm.send.latency" and some are tagged, for example failures with the FCM
+    error code as `error`. We record:
+
+    - `fcm.send.latency` seconds each request to FCM took
+    - `fcm.send.batch_size` devices sent to per request
+    - `fcm.send.success` devices sent to successfully
+    - `fcm.send.failure` devices FCM returned an error for, tagged by `error`
+    - `fcm.send.retries` devices sent to again, see `RETRY_ATTEMPTS`
+    - `fcm.send.exceptions` requests raising, tagged by `exception`
+    - `fcm.devices.deactivated` devices deactivated due to errors
+    - `fcm.devices.canonicalised` devices whose token FCM gave a canonical id for
+    - `fcm.devices.upsert.latency` seconds each batched registration upsert took
+    - `fcm.devices.upsert.batch_size` devices registered per upsert
+    - `fcm.devices.pruned` devices deleted or deactivated by `prune_devices`
+    """
+
+    def increment(self, name, value=1, **tags):
+        """Add to a counter."""
+
+    def observe(self, name, value, **tags):
+        """Record a value in a distribution, ie - a latency."""
+
+    @contextmanager
+    def timer(self, name, **tags):
+        """Observe how many seconds the block takes."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **tags)
+
+
+class InMemoryMetrics(MetricsSink):
+    """
+    Keep metrics in memory, for tests and poking around in a shell.
+
+    Every observed value is kept, so this isn't one for long-lived processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = Counter()
+            self.observations = defaultdict(list)
+
+    @staticmethod
+    def key(name, tags):
+        return (name, tuple(sorted(tags.items())))
+
+    def increment(self, name, value=1, **tags):
+        with self._lock:
+            self.counters[self.key(name, tags)] += value
+
+    def observe(self, name, value, **tags):
+        with self._lock:
+            self.observations[self.key(name, tags)].append(value)
+
+    def count(self, name, **tags):
+        with self._lock:
+            return self.counters[self.key(name, tags)]
+
+    def summary(self, name, **tags):
+        """Count, min, max, mean, p50 and p99 of the values observed."""
+        with self._lock:
+            values = sorted(self.observations[self.key(name, tags)])
+        if not values:
+            return {"count": 0}
+        return {
+            "count": len(values),
+            "min": values[0],
+            "max": values[-1],
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p99": percentile(values, 99),
+        }
+
+
+class LoggingMetrics(MetricsSink):
+    """Log each metric to the `fcm_devices.metrics` logger at INFO level."""
+
+    def log(self, name, value, tags):
+        tags = "".join(f" {key}={value}" for key, value in sorted(tags.items()))
+        logger.info("%s=%s%s", name, value, tags)
+
+    def increment(self, name, value=1, **tags):
+        self.log(name, value, tags)
+
+    def observe(self, name, value, **tags):
+        self.log(name, value, tags)
+
+
+@lru_cache(maxsize=None)
+def get_metrics():
+    """
+    Return the configured `MetricsSink`, built once per process and rebuilt
+    whenever an `FCM_DEVICES_*` setting changes.
+    """
+    if app_settings.METRICS_SINK is None:
+        return MetricsSink()
+    return import_string(app_settings.METRICS_SINK)()
+
+
+@receiver(setting_changed)
+def reset_metrics(setting, **kwargs):
+    if setting.startswith(f"{app_settings.prefix}_"):
+        get_metrics.cache_clear()
@@ -0,0 +1,57 @@
+import hashlib
+
+from django.db import migrations, models
+
+from fcm_devices.operations import AddIndexConcurrently
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_token_hashes(apps, schema_editor):
+    """
+    Populate `token_hash` in batches of ids, so that on a large table no one
+    statement runs for long. This migration isn't atomic, so each batch is
+    committed as it goes.
+    """
+    Device = apps.get_model("fcm_devices", "Device")
+    db_alias = schema_editor.connection.alias
+    last_id = 0
+    while True:
+        batch = list(
+            Device.objects.using(db_alias)
+            .filter(id__gt=last_id)
+            .order_by("id")
+            .only("id", "token")[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for device in batch:
+            device.token_hash = hashlib.sha256(device.token.encode()).hexdigest()
+        Device.objects.using(db_alias).bulk_update(batch, ["token_hash"])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    # batches are committed as they go, and CREATE INDEX CONCURRENTLY can't
+    # run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("fcm_devices", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="device",
+            name="token_hash",
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_token_hashes, migrations.RunPython.noop),
+        # left nullable, as adding NOT NULL would scan the table under a lock
+        AddIndexConcurrently(
+            model_name="device",
+            index=models.Index(fields=["token_hash"], name="fcm_device_token_hash_idx"),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+from fcm_devices.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("fcm_devices", "0002_device_token_hash"),
+    ]
+
+    # databases without partial index support skip the conditional index, which
+    # is fine as their queries are still covered by the index on `user_id`
+    operations = [
+        AddIndexConcurrently(
+            model_name="device",
+            index=models.Index(
+                condition=models.Q(("active", True)),
+                fields=["user"],
+                name="fcm_device_user_active_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="device",
+            index=models.Index(
+                fields=["type", "active"], name="fcm_device_type_active_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+import konst.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("fcm_devices", "0003_device_active_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="NotificationOutbox",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "payload",
+                    models.TextField(
+                        help_text="JSON encoded kwargs for the backend's send, ie - message_body"
+                    ),
+                ),
+                (
+                    "status",
+                    konst.models.fields.ConstantChoiceCharField(
+                        choices=[
+                            ("pending", "pending"),
+                            ("sending", "sending"),
+                            ("sent", "sent"),
+                            ("failed", "failed"),
+                        ],
+                        default="pending",
+                        max_length=30,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                (
+                    "error",
+                    models.CharField(
+                        blank=True,
+                        help_text="The FCM error code, if any",
+                        max_length=255,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(default=django.utils.timezone.now)),
+                ("claimed_at", models.DateTimeField(blank=True, null=True)),
+                ("sent_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "device",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="outbox",
+                        to="fcm_devices.device",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="notificationoutbox",
+            index=models.Index(fields=["status", "id"], name="fcm_outbox_status_idx"),
+        ),
+    ]
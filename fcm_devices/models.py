@@ -1,10 +1,152 @@
+import hashlib
+
 from django.conf import settings
-from django.db import models
+from django.db import connections, models, transaction
 from django.utils import timezone
 
 from konst import Constant, Constants
 from konst.models.fields import ConstantChoiceCharField
 
+from .metrics import get_metrics
+from .settings import app_settings
+from .utils import chunked
+
+
+def hash_token(token):
+    """Fixed-width digest of a registration token, for indexed lookups."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class DeviceQuerySet(models.QuerySet):
+    def by_token(self, token):
+        """Devices with the given token, whichever user they belong to."""
+        return self.filter(token_hash=hash_token(token))
+
+    def by_tokens(self, tokens):
+        """Devices with any of the given tokens, whichever user they belong to."""
+        return self.filter(token_hash__in=[hash_token(token) for token in tokens])
+
+
+class DeviceManager(models.Manager.from_queryset(DeviceQuerySet)):
+    def upsert(self, user, token, **defaults):
+        """
+        Create or update the device for a user and token, returning it along
+        with whether it was created.
+
+        See `bulk_upsert`, which does the work.
+        """
+        return self.bulk_upsert(user, [dict(defaults, token=token)])[0]
+
+    def bulk_upsert(self, user, devices):
+        """
+        Create or update many devices for a user, given as dicts of field values
+        including the `token`, returning `(instance, created)` pairs in order.
+
+        Where the database supports it this is a single
+        `INSERT ... ON CONFLICT (user_id, token) DO UPDATE ... RETURNING`
+        statement per `DB_BATCH_SIZE` devices, avoiding both the
+        `SELECT ... FOR UPDATE` of `update_or_create` and the `IntegrityError`
+        retries concurrent registrations of the same token can cause it.
+        Otherwise we fall back to `update_or_create` for each device.
+        """
+        connection = connections[self.db]
+        metrics = get_metrics()
+        if not self.supports_upsert(connection):
+            metrics.observe("fcm.devices.upsert.batch_size", len(devices))
+            timer = metrics.timer("fcm.devices.upsert.latency")
+            with timer, transaction.atomic(using=self.db):
+                return [
+                    self.update_or_create(
+                        user=user, token=values["token"], defaults=values
+                    )
+                    for values in devices
+                ]
+
+        results = []
+        for chunk in chunked(devices, app_settings.DB_BATCH_SIZE):
+            metrics.observe("fcm.devices.upsert.batch_size", len(chunk))
+            with metrics.timer("fcm.devices.upsert.latency"):
+                results.extend(self._upsert_chunk(connection, user, chunk))
+        return results
+
+    def _upsert_chunk(self, connection, user, devices):
+        now = timezone.now()
+        meta = self.model._meta
+        qn = connection.ops.quote_name
+        names = ["user", "token_hash", "created_at", "updated_at", *devices[0]]
+        fields = [meta.get_field(name) for name in names]
+        params = []
+        for values in devices:
+            values = dict(
+                values,
+                user=user.pk,
+                token_hash=hash_token(values["token"]),
+                created_at=now,
+                updated_at=now,
+            )
+            params.extend(
+                field.get_db_prep_save(values[field.name], connection)
+                for field in fields
+            )
+        columns = [qn(field.column) for field in fields]
+        conflict = [qn(meta.get_field(name).column) for name in ("user", "token")]
+        created_at = meta.get_field("created_at")
+        unchanging = conflict + [
+            qn(meta.get_field(name).column) for name in ("token_hash", "created_at")
+        ]
+        updates = [
+            f"{column} = excluded.{column}"
+            for column in columns
+            if column not in unchanging
+        ]
+        row = f"({', '.join(['%s'] * len(columns))})"
+        sql = (
+            f"INSERT INTO {qn(meta.db_table)} ({', '.join(columns)}) "
+            f"VALUES {', '.join([row] * len(devices))} "
+            f"ON CONFLICT ({', '.join(conflict)}) DO UPDATE SET {', '.join(updates)} "
+            f"RETURNING {qn(meta.pk.column)}, {qn(meta.get_field('token').column)}, "
+            f"{qn(created_at.column)}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        column = created_at.get_col(meta.db_table)
+        converters = connection.ops.get_db_converters(
+            column
+        ) + column.get_db_converters(connection)
+        returned = {}
+        for pk, token, created_at_value in rows:
+            for converter in converters:
+                created_at_value = converter(created_at_value, column, connection)
+            returned[token] = (pk, created_at_value)
+
+        results = []
+        for values in devices:
+            pk, created_at_value = returned[values["token"]]
+            instance = self.model(
+                pk=pk,
+                user=user,
+                token_hash=hash_token(values["token"]),
+                created_at=created_at_value,
+                updated_at=now,
+                **values,
+            )
+            instance._state.adding = False
+            instance._state.db = self.db
+            # an existing row keeps its original created_at
+            results.append((instance, created_at_value == now))
+        return results
+
+    @staticmethod
+    def supports_upsert(connection):
+        if connection.vendor == "postgresql":
+            return True
+        if connection.vendor == "sqlite":
+            # RETURNING arrived in SQLite 3.35
+            return connection.Database.sqlite_version_info >= (3, 35)
+        return False
+
 
 class Device(models.Model):
     """
@@ -20,6 +162,10 @@ class Device(models.Model):
 
     This uniqueness constraint also lets us use `update_or_create` et al and
     create a low-friction API.
+
+    To look devices up by token alone use `Device.objects.by_token` and
+    `by_tokens`, which use an indexed digest of the token kept in `token_hash`.
+    Anything writing tokens without going through `save` must keep it in sync.
     """
 
     id = models.BigAutoField(primary_key=True)
@@ -41,13 +187,81 @@ class Device(models.Model):
     )
     type = ConstantChoiceCharField(constants=types, max_length=30)
     token = models.TextField(help_text="The FCM registration token value")
+    # tokens are long and unbounded, so we look them up by a digest instead
+    token_hash = models.CharField(max_length=64, null=True, editable=False)
 
     # some timestamps for our info
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(default=timezone.now)
 
+    objects = DeviceManager()
+
     class Meta:
         unique_together = ("user", "token")
+        indexes = [
+            # fan-out to a user's devices only ever wants the active ones, and
+            # inactive rows pile up over time
+            models.Index(
+                fields=["user"],
+                condition=models.Q(active=True),
+                name="fcm_device_user_active_idx",
+            ),
+            # for lookups by token, which only ever compare the whole digest
+            models.Index(fields=["token_hash"], name="fcm_device_token_hash_idx"),
+            # for sends and admin filtering by platform
+            models.Index(fields=["type", "active"], name="fcm_device_type_active_idx"),
+        ]
 
     def __str__(self):
         return f"{self.user} on {self.type} w/ token {self.token[:10]}..."
+
+    def save(self, *args, **kwargs):
+        self.token_hash = hash_token(self.token)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "token" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "token_hash"}
+        super().save(*args, **kwargs)
+
+
+class NotificationOutbox(models.Model):
+    """
+    A notification waiting to be sent to a device, so that callers needn't
+    wait on FCM and sends survive the process dying.
+
+    Rows are added by `service.enqueue_notification` and sent by the
+    `fcm_drain_outbox` management command, see `fcm_devices.outbox`.
+    """
+
+    statuses = Constants(
+        Constant(pending="pending"),
+        Constant(sending="sending"),
+        Constant(sent="sent"),
+        Constant(failed="failed"),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name="outbox")
+    payload = models.TextField(
+        help_text="JSON encoded kwargs for the backend's send, ie - message_body"
+    )
+    status = ConstantChoiceCharField(
+        constants=statuses, default="pending", max_length=30
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.CharField(
+        max_length=255, blank=True, help_text="The FCM error code, if any"
+    )
+
+    created_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # workers claim the oldest pending or abandoned rows
+            models.Index(fields=["status", "id"], name="fcm_outbox_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.status} notification for device {self.device_id}"
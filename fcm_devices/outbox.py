@@ -0,0 +1,213 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+import json
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .fcm import configuration_errors, get_fcm_backend, retryable_errors
+from .models import NotificationOutbox
+from .settings import app_settings
+from .utils import chunked
+
+
+statuses = NotificationOutbox.statuses
+
+
+def encode_payload(kwargs):
+    """Encode send kwargs so that identical payloads compare equal."""
+    return json.dumps(kwargs, sort_keys=True, separators=(",", ":"))
+
+
+def claimable():
+    """
+    Rows waiting to be sent, unless they were tried within `OUTBOX_RETRY_DELAY`,
+    or claimed by a worker that since went away.
+    """
+    now = timezone.now()
+    lease = now - timedelta(seconds=app_settings.OUTBOX_LEASE)
+    retry = now - timedelta(seconds=app_settings.OUTBOX_RETRY_DELAY)
+    pending = Q(status=statuses.pending) & (
+        Q(claimed_at__isnull=True) | Q(claimed_at__lt=retry)
+    )
+    abandoned = Q(status=statuses.sending, claimed_at__lt=lease)
+    return NotificationOutbox.objects.filter(pending | abandoned)
+
+
+def claim(batch_size):
+    """
+    Claim up to `batch_size` rows for this worker, oldest first, returning the
+    claim time and the rows.
+
+    Rows are locked with `SELECT ... FOR UPDATE SKIP LOCKED`, so concurrent
+    workers each claim different rows, and marked as sending in the same short
+    transaction. The send itself happens after it commits. Abandoned rows
+    already tried `OUTBOX_MAX_ATTEMPTS` times are marked failed instead.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = list(
+            claimable()
+            .select_for_update(skip_locked=True)
+            .order_by("id")
+            .values_list("id", "status", "attempts")[:batch_size]
+        )
+        ids, exhausted = [], []
+        for pk, status, attempts in claimed:
+            abandoned = status == statuses.sending
+            if abandoned and attempts >= app_settings.OUTBOX_MAX_ATTEMPTS:
+                exhausted.append(pk)
+            else:
+                ids.append(pk)
+        for chunk in chunked(exhausted, app_settings.DB_BATCH_SIZE):
+            NotificationOutbox.objects.filter(id__in=chunk).update(
+                status=statuses.failed, error="Abandoned"
+            )
+        for chunk in chunked(ids, app_settings.DB_BATCH_SIZE):
+            NotificationOutbox.objects.filter(id__in=chunk).update(
+                status=statuses.sending, claimed_at=now, attempts=F("attempts") + 1
+            )
+    rows = []
+    for chunk in chunked(ids, app_settings.DB_BATCH_SIZE):
+        rows.extend(
+            NotificationOutbox.objects.filter(id__in=chunk)
+            .select_related("device")
+            .order_by("id")
+        )
+    return now, rows
+
+
+def renew(rows, claimed_at):
+    """
+    Renew this worker's lease on claimed rows, returning the new claim time and
+    those rows still ours, leaving out any reclaimed since `claimed_at`.
+    """
+    now = timezone.now()
+    ids = []
+    for chunk in chunked([row.id for row in rows], app_settings.DB_BATCH_SIZE):
+        with transaction.atomic():
+            ours = list(
+                NotificationOutbox.objects.filter(
+                    id__in=chunk, status=statuses.sending, claimed_at=claimed_at
+                )
+                .select_for_update()
+                .values_list("id", flat=True)
+            )
+            NotificationOutbox.objects.filter(id__in=ours).update(claimed_at=now)
+        ids.extend(ours)
+    ids = set(ids)
+    return now, [row for row in rows if row.id in ids]
+
+
+def drain(batch_size=1000):
+    """
+    Claim and send a batch of rows, returning a `Counter` of their new statuses,
+    which is empty once there's nothing left to send.
+
+    Rows with identical payloads are sent together with `send_bulk`, renewing
+    the lease on them first, so `OUTBOX_LEASE` only needs to outlast sending
+    one payload rather than the whole batch. Any reclaimed by another worker
+    meanwhile are left to it. Those failing with transient errors go back to
+    pending, to be tried again after `OUTBOX_RETRY_DELAY`, until they've been
+    tried `OUTBOX_MAX_ATTEMPTS` times. Should sending raise, say for a
+    configuration error, rows already sent keep their outcome, the rest are
+    released for another go and the exception is re-raised.
+    """
+    claimed_at, rows = claim(batch_size)
+    counts = Counter()
+    groups = defaultdict(list)
+    inactive = []
+    for row in rows:
+        if row.device.active:
+            groups[row.payload].append(row)
+        else:
+            inactive.append(row.id)
+    mark({(statuses.failed, "Inactive"): inactive}, claimed_at, counts)
+
+    unsent = {row.id for group in groups.values() for row in group}
+    for payload, group in groups.items():
+        unsent.difference_update(row.id for row in group)
+        renewed_at, group = renew(group, claimed_at)
+        outcomes = defaultdict(list)
+        try:
+            send(payload, group, outcomes)
+        except Exception:
+            done = {row_id for ids in outcomes.values() for row_id in ids}
+            outcomes[(statuses.pending, "")].extend(
+                row.id for row in group if row.id not in done
+            )
+            mark(outcomes, renewed_at, counts)
+            mark({(statuses.pending, ""): unsent}, claimed_at, counts)
+            raise
+        mark(outcomes, renewed_at, counts)
+    return counts
+
+
+def send(payload, rows, outcomes):
+    """
+    Send a payload to claimed rows, adding their ids to `outcomes` grouped by
+    `(status, error)`.
+    """
+    if not rows:
+        return outcomes
+    # each row has its own device instance, so map back by identity
+    by_device = {id(row.device): row for row in rows}
+    devices = [row.device for row in rows]
+    try:
+        result = get_fcm_backend().send_bulk(devices, **json.loads(payload))
+    except Exception as e:
+        result = getattr(e, "result", None)
+        if result is not None:
+            add_outcomes(result, by_device, outcomes)
+        raise
+    add_outcomes(result, by_device, outcomes)
+    return outcomes
+
+
+def add_outcomes(result, by_device, outcomes):
+    """Add the outcome of each row in a `BulkResult` to `outcomes`."""
+    for device, device_result in result.results:
+        row = by_device[id(device)]
+        error = device_result.get("error", "")
+        if error in retryable_errors:
+            outcomes[(retry_status(row), error)].append(row.id)
+        elif error in configuration_errors:
+            # not the row's fault, so it can go again once that's fixed
+            outcomes[(statuses.pending, error)].append(row.id)
+        elif error:
+            outcomes[(statuses.failed, error)].append(row.id)
+        else:
+            outcomes[(statuses.sent, "")].append(row.id)
+    for devices, exception in result.exceptions:
+        for device in devices:
+            row = by_device[id(device)]
+            outcomes[(retry_status(row), type(exception).__name__)].append(row.id)
+
+
+def retry_status(row):
+    if row.attempts < app_settings.OUTBOX_MAX_ATTEMPTS:
+        return statuses.pending
+    return statuses.failed
+
+
+def mark(outcomes, claimed_at, counts):
+    """
+    Record the outcome of sending rows, in one update per outcome and batch,
+    adding how many of each status to `counts`.
+
+    Only rows still held under the claim made at `claimed_at` are updated, so
+    the outcome of a row another worker has since reclaimed is left to it.
+    """
+    now = timezone.now()
+    for (status, error), ids in outcomes.items():
+        for chunk in chunked(ids, app_settings.DB_BATCH_SIZE):
+            marked = NotificationOutbox.objects.filter(
+                id__in=chunk, status=statuses.sending, claimed_at=claimed_at
+            ).update(
+                status=status,
+                error=error,
+                sent_at=now if status == statuses.sent else None,
+            )
+            if marked:
+                counts[str(status)] += marked
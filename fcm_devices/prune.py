@@ -0,0 +1,72 @@
+from datetime import timedelta
+import time
+
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from .metrics import get_metrics
+from .models import Device
+from .signals import devices_pruned
+
+
+def prunable(inactive_days=None, stale_days=None, delete=True):
+    """
+    Devices to prune: inactive ones not updated in `inactive_days`, and any not
+    updated in `stale_days`. When deactivating rather than deleting, only those
+    still active.
+    """
+    now = timezone.now()
+    condition = Q(pk__in=[])
+    if inactive_days is not None:
+        condition |= Q(active=False, updated_at__lt=now - timedelta(days=inactive_days))
+    if stale_days is not None:
+        condition |= Q(updated_at__lt=now - timedelta(days=stale_days))
+    queryset = Device.objects.filter(condition)
+    if not delete:
+        queryset = queryset.filter(active=True)
+    return queryset
+
+
+def prune_devices(
+    inactive_days=None,
+    stale_days=None,
+    delete=True,
+    chunk_size=1000,
+    pause=0.1,
+    progress=None,
+):
+    """
+    Delete, or deactivate, the devices `prunable` returns, returning how many.
+
+    The id space is walked in ranges of `chunk_size`, each pruned in its own
+    short transaction, pausing for `pause` seconds after any range that
+    changed something, so a live database isn't locked for long or its
+    replicas left behind. A `devices_pruned` signal is fired for each range
+    once committed, and `progress(pruned)` called if given.
+    """
+    queryset = prunable(inactive_days, stale_days, delete)
+    bounds = Device.objects.aggregate(start=Min("id"), end=Max("id"))
+    if bounds["start"] is None:
+        return 0
+    total = 0
+    for start in range(bounds["start"], bounds["end"] + 1, chunk_size):
+        chunk = queryset.filter(id__gte=start, id__lt=start + chunk_size)
+        with transaction.atomic():
+            rows = list(chunk.select_for_update().values_list("id", "user_id"))
+            if not rows:
+                continue
+            if delete:
+                chunk.delete()
+            else:
+                chunk.update(active=False, updated_at=timezone.now())
+        device_ids, user_ids = (list(values) for values in zip(*rows))
+        get_metrics().increment("fcm.devices.pruned", len(device_ids))
+        devices_pruned.send(
+            sender=Device, device_ids=device_ids, user_ids=user_ids, deleted=delete
+        )
+        total += len(device_ids)
+        if progress is not None:
+            progress(total)
+        time.sleep(pause)
+    return total
@@ -0,0 +1,132 @@
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .settings import app_settings
+
+
+def parse_retry_after(headers):
+    """
+    Return the seconds to wait given by a `Retry-After` header, which may be
+    a number of seconds or an HTTP date, or None if there isn't one.
+    """
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        # HTTP dates are always GMT
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter(object):
+    """
+    A token bucket, shared between threads, pacing requests to FCM.
+
+    Requests are allowed at `rate` per second with bursts of up to `burst`.
+    When FCM tells us to back off, every request waits until the `Retry-After`
+    has passed, and on any sign we're sending too fast the rate is halved. It
+    then recovers linearly back to `rate` over `recovery` seconds, so we settle
+    near the sustainable rate instead of alternating between bursts and
+    failures.
+    """
+
+    def __init__(self, rate, burst=None, recovery=60.0, min_rate=1.0):
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.capacity = float(burst or rate)
+        self.recovery = recovery
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self.slowed_at = None
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rate < self.max_rate:
+            self.rate = min(
+                self.max_rate, self.rate + self.max_rate * elapsed / self.recovery
+            )
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def reserve(self):
+        """Take a token, returning how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def slow_down(self):
+        """Halve the rate, at most once a second however many sends see errors."""
+        with self._lock:
+            now = time.monotonic()
+            if self.slowed_at is not None and now - self.slowed_at < 1:
+                return
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.slowed_at = now
+
+    def pause(self, seconds):
+        """Hold back every request for `seconds`, and slow down after."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.slow_down()
+
+
+class RateLimiters(object):
+    """One `RateLimiter` per API key, if `RATE_LIMIT` is set."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def get(self, api_key):
+        if app_settings.RATE_LIMIT is None:
+            return None
+        with self._lock:
+            limiter = self._limiters.get(api_key)
+            if limiter is None:
+                limiter = self._limiters[api_key] = RateLimiter(
+                    app_settings.RATE_LIMIT, app_settings.RATE_LIMIT_BURST
+                )
+            return limiter
+
+    def reset(self):
+        with self._lock:
+            self._limiters = {}
+
+
+rate_limiters = RateLimiters()
+
+
+@receiver(setting_changed)
+def reset_rate_limiters(setting, **kwargs):
+    if setting.startswith(f"{app_settings.prefix}_"):
+        rate_limiters.reset()
@@ -1,18 +1,39 @@
+import asyncio
+from datetime import timedelta
+
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from asgiref.sync import sync_to_async
+
 from . import signals
-from .fcm import get_fcm_backend
-from .models import Device
+from .cache import user_device_cache
+from .coalesce import current_buffer
+from .dedup import deduplicator
+from .fcm import BulkResult, get_fcm_backend
+from .models import Device, NotificationOutbox
+from .outbox import encode_payload
+from .settings import app_settings
+from .utils import chunked, unique_by_token
 
 
 def update_or_create_device(user, token, active, _type, name):
     """
     Create or update a device and fire an appropriate signal
     for other apps to potentially use.
+
+    Clients re-register the same details on every launch, so if nothing has
+    changed we skip the write and the signal, only refreshing `updated_at` if
+    it is older than `TOUCH_INTERVAL` hours.
     """
-    instance, created = Device.objects.update_or_create(
-        user=user,
-        token=token,
-        defaults={"active": active, "type": _type, "name": name},
-    )
+    defaults = {"active": active, "type": _type, "name": name}
+    instance = Device.objects.filter(user=user, token=token).first()
+    if instance is not None and is_unchanged(instance, defaults):
+        touch_devices([instance])
+        return instance, False
+
+    instance, created = Device.objects.upsert(user=user, token=token, **defaults)
+    deactivate_other_owners(user, [instance])
     if created:
         signals.device_created.send(sender=Device, device=instance)
     else:
@@ -20,24 +41,305 @@ def update_or_create_device(user, token, active, _type, name):
     return instance, created
 
 
+def bulk_update_or_create_devices(user, devices):
+    """
+    Create or update many devices for a user at once, given as dicts of
+    `token`, `active`, `type` and `name` with each token appearing only once.
+
+    Returns `(instance, status)` pairs in order, where status is one of
+    "created", "updated" or "unchanged". Unchanged devices are treated as in
+    `update_or_create_device`, the rest are written with a batched upsert and
+    the `devices_created` and `devices_updated` signals fired once each.
+    """
+    existing = {}
+    for tokens in chunked([d["token"] for d in devices], app_settings.DB_BATCH_SIZE):
+        existing.update(
+            (device.token, device)
+            for device in Device.objects.filter(user=user, token__in=tokens)
+        )
+
+    results = {}
+    unchanged = []
+    changed = []
+    for values in devices:
+        instance = existing.get(values["token"])
+        if instance is not None and is_unchanged(instance, values):
+            unchanged.append(instance)
+            results[instance.token] = (instance, "unchanged")
+        else:
+            changed.append(values)
+    touch_devices(unchanged)
+
+    created, updated = [], []
+    for instance, was_created in Device.objects.bulk_upsert(user, changed):
+        (created if was_created else updated).append(instance)
+        results[instance.token] = (
+            instance,
+            "created" if was_created else "updated",
+        )
+    deactivate_other_owners(user, created + updated)
+    if created:
+        signals.devices_created.send(sender=Device, devices=created)
+    if updated:
+        signals.devices_updated.send(sender=Device, devices=updated)
+    return [results[values["token"]] for values in devices]
+
+
+def deactivate_other_owners(user, devices):
+    """
+    With an "exclusive" `REGISTRATION_POLICY`, deactivate other users' active
+    devices with the tokens of the active `devices` just registered for `user`,
+    so only the token's latest owner is sent to.
+    """
+    if app_settings.REGISTRATION_POLICY != "exclusive":
+        return
+    tokens = [device.token for device in devices if device.active]
+    device_ids = []
+    for chunk in chunked(tokens, app_settings.DB_BATCH_SIZE):
+        device_ids.extend(
+            Device.objects.by_tokens(chunk)
+            .filter(active=True)
+            .exclude(user=user)
+            .values_list("id", flat=True)
+        )
+    if device_ids:
+        get_fcm_backend().deactivate_devices(device_ids)
+
+
+def is_unchanged(device, values):
+    return all(
+        getattr(device, field) == value
+        for field, value in values.items()
+        if field != "token"
+    )
+
+
+def touch_devices(devices):
+    """
+    Refresh `updated_at` for unchanged devices where it's older than
+    `TOUCH_INTERVAL` hours, in batched updates.
+    """
+    if app_settings.TOUCH_INTERVAL is None:
+        return
+    now = timezone.now()
+    stale = [
+        device
+        for device in devices
+        if device.updated_at < now - timedelta(hours=app_settings.TOUCH_INTERVAL)
+    ]
+    for chunk in chunked(stale, app_settings.DB_BATCH_SIZE):
+        Device.objects.filter(pk__in=[device.pk for device in chunk]).update(
+            updated_at=now
+        )
+        for device in chunk:
+            device.updated_at = now
+
+
 def send_notification(device, **kwargs):
     """
     Send a push notification to a device.
 
     Note that kwargs are passed through to the backend which by default
     uses pyfcm, so you can check their docs for what you can include.
+
+    Within `coalesce_sends` the send is buffered and `None` returned, as it is
+    for a repeat dropped within `DEDUP_WINDOW`.
     """
-    return get_fcm_backend().send_notification(device, **kwargs)
+    buffer = current_buffer()
+    if buffer is not None:
+        return buffer.add(devices=[device], **kwargs)
+    for kwargs, _ in deduplicator.dedupe([device], kwargs):
+        return get_fcm_backend().send_notification(device, **kwargs)
 
 
 def send_notification_to_user(user, **kwargs):
     """
-    Send a push notification to all active devices for a User.
+    Send a push notification to all active devices for a User, which are
+    cached if `USER_CACHE_TIMEOUT` is set.
+
+    Returns the responses in device order. If `SEND_WORKERS` is set the
+    devices are sent to in parallel with the backend's `send_notifications`,
+    and any exception raised sending to a device is returned in place of its
+    response rather than aborting the rest.
+
+    Within `coalesce_sends` the send is buffered and `None` returned.
+    """
+    buffer = current_buffer()
+    if buffer is not None:
+        return buffer.add(user_ids=[user.pk], **kwargs)
+    devices = user_device_cache.get_devices(user)
+    if app_settings.SEND_WORKERS:
+        backend = get_fcm_backend()
+        responses = {}
+        for send_kwargs, deduped in deduplicator.dedupe(devices, kwargs):
+            sent = backend.send_notifications(deduped, **send_kwargs)
+            responses.update(zip(map(id, deduped), sent))
+        return [responses.get(id(device)) for device in devices]
+    return [send_notification(device, **kwargs) for device in devices]
+
+
+def send_notification_bulk(devices, **kwargs):
+    """
+    Send the same push notification to many devices at once.
+
+    Devices can be given as any iterable or as a queryset, which will be
+    iterated over rather than loaded into memory in one go. Tokens are sent
+    using FCM multicast in chunks of up to 1000, and the aggregate `BulkResult`
+    maps each FCM result back to its device. A token shared by several devices
+    is only sent to once, for the first of them.
     """
-    devices = Device.objects.filter(user=user, active=True)
-    for device in devices:
-        send_notification(device, **kwargs)
+    if isinstance(devices, QuerySet):
+        devices = devices.iterator()
+    return get_fcm_backend().send_bulk(unique_by_token(devices), **kwargs)
+
+
+def enqueue_notification(device, **kwargs):
+    """
+    Queue a push notification to a device, to be sent by the `fcm_drain_outbox`
+    management command instead of while the caller waits.
+
+    Takes the same kwargs as `send_notification`, which must be JSON
+    serializable.
+    """
+    return NotificationOutbox.objects.create(
+        device=device, payload=encode_payload(kwargs)
+    )
+
+
+def enqueue_notification_bulk(devices, **kwargs):
+    """
+    Queue the same push notification to many devices, in batched inserts,
+    returning how many were queued.
+
+    Queued together, they'll be sent together in multicasts.
+    """
+    if isinstance(devices, QuerySet):
+        devices = devices.iterator()
+    payload = encode_payload(kwargs)
+    count = 0
+    for chunk in chunked(devices, app_settings.DB_BATCH_SIZE):
+        NotificationOutbox.objects.bulk_create(
+            [NotificationOutbox(device=device, payload=payload) for device in chunk]
+        )
+        count += len(chunk)
+    return count
+
+
+def send_notification_to_queryset(queryset, **kwargs):
+    """
+    Send the same push notification to every active device in a queryset, for
+    audiences too big to hold in memory.
+
+    Devices are fetched a page at a time, walking their ids in order, as
+    `(id, type, token)` tuples rather than full instances, and each token is
+    only sent to once. Each page is sent with `send_bulk`, and is sized to
+    fill every `SEND_WORKERS` thread with a multicast. No cursor or
+    transaction is held open between pages.
+
+    Returns a `BulkResult` of the counts, deactivations and exceptions of all
+    pages, but not their per-device `results`, so memory use doesn't grow with
+    the audience.
+    """
+    backend = get_fcm_backend()
+    total = BulkResult()
+    for devices in iter_device_pages(queryset, backend):
+        total.merge(backend.send_bulk(devices, **kwargs))
+    return total
+
+
+def iter_device_pages(
+    queryset, backend, active=True, after=None, audience=None, user_ids=None
+):
+    """
+    Yield pages of the devices in a queryset, in id order and after the id
+    `after` if given, sized for `send_bulk`. Pass `active=None` for both
+    active and inactive devices.
+
+    Each token is only yielded for the lowest id device with it in `audience`,
+    which defaults to the queryset, so a token shared by several users is only
+    sent to once. They're found with one indexed lookup of each page's tokens.
+    If given, `user_ids` limits `audience` to those users, checked here rather
+    than sent to the database with every lookup.
+    """
+    page_size = backend.max_recipients * (app_settings.SEND_WORKERS or 1)
+    fields = ("id", "type", "token", "token_hash")
+    if active is not None:
+        queryset = queryset.filter(active=active)
+        fields = ("id", "active", "type", "token", "token_hash")
+    if audience is None:
+        audience = queryset
+    queryset = queryset.order_by("id")
+    while True:
+        page = queryset if after is None else queryset.filter(id__gt=after)
+        rows = list(page.values_list("id", "type", "token", "token_hash")[:page_size])
+        if not rows:
+            return
+        after = rows[-1][0]
+        # the lowest id in the audience for each token in the page
+        first = {}
+        for hashes in chunked({row[-1] for row in rows}, app_settings.DB_BATCH_SIZE):
+            earlier = audience.filter(token_hash__in=hashes, id__lte=after)
+            for token_hash, pk, user_id in earlier.values_list(
+                "token_hash", "id", "user_id"
+            ):
+                if user_ids is None or user_id in user_ids:
+                    first[token_hash] = min(pk, first.get(token_hash, pk))
+        # only the fields we fetched are loaded, the rest are deferred
+        known = () if active is None else (active,)
+        devices = [
+            Device.from_db(None, fields, (pk, *known, *row))
+            for pk, *row in rows
+            if first.get(row[-1], pk) >= pk
+        ]
+        if devices:
+            yield devices
+        if len(rows) < page_size:
+            return
+
+
+# async counterparts of the above, for use from async views and consumers.
+# These work with any backend, but only `AsyncFCMBackend` sends natively
+# rather than in a thread.
+
+
+async def asend_notification(device, **kwargs):
+    """Async version of `send_notification`."""
+    if not deduplicator.enabled:
+        return await get_fcm_backend().asend_notification(device, **kwargs)
+    # the dedup cache may block, so check it from a thread
+    for kwargs, _ in await sync_to_async(deduplicator.dedupe)([device], kwargs):
+        return await get_fcm_backend().asend_notification(device, **kwargs)
+
+
+async def asend_notification_to_user(user, **kwargs):
+    """
+    Async version of `send_notification_to_user`, sending to the user's
+    devices concurrently.
+
+    Returns the responses in device order, with any exception raised sending
+    to a device in place of its response rather than aborting the rest.
+    """
+    devices = await sync_to_async(user_device_cache.get_devices)(user)
+    return await asyncio.gather(
+        *[asend_notification(device, **kwargs) for device in devices],
+        return_exceptions=True,
+    )
+
+
+async def asend_notification_to_queryset(queryset, **kwargs):
+    """Async version of `send_notification_to_queryset`."""
+    backend = get_fcm_backend()
+    pages = iter_device_pages(queryset, backend)
+    total = BulkResult()
+    while True:
+        devices = await sync_to_async(next)(pages, None)
+        if devices is None:
+            return total
+        total.merge(await backend.asend_bulk(devices, **kwargs))
 
 
-# TODO: add functions for bulk sends, data messages, etc. For now
-# if you need these, just subclass FCMBackend and hit it directly
+async def asend_notification_bulk(devices, **kwargs):
+    """Async version of `send_notification_bulk`."""
+    if isinstance(devices, QuerySet):
+        devices = await sync_to_async(list)(devices)
+    return await get_fcm_backend().asend_bulk(list(unique_by_token(devices)), **kwargs)
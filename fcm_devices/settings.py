@@ -1,7 +1,16 @@
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 
 class AppSettings(object):
+    """
+    Look up app settings, falling back to their defaults.
+
+    Values are cached on first access, as they're read on every send, and
+    reloaded whenever one of our settings changes.
+    """
+
     def __init__(self, prefix, defaults):
         self.prefix = prefix
         self.defaults = defaults
@@ -9,7 +18,14 @@ class AppSettings(object):
     def __getattr__(self, attr):
         if attr not in self.defaults:
             raise AttributeError(f"Invalid app setting: {attr}")
-        return getattr(settings, f"{self.prefix}_{attr}", self.defaults[attr])
+        value = getattr(settings, f"{self.prefix}_{attr}", self.defaults[attr])
+        # from now on found without calling __getattr__
+        setattr(self, attr, value)
+        return value
+
+    def reload(self):
+        for attr in self.defaults:
+            self.__dict__.pop(attr, None)
 
 
 DEFAULTS = {
@@ -17,7 +33,69 @@ DEFAULTS = {
     "API_KEY": None,
     # allow customisation of how messages are actually sent
     "BACKEND_CLASS": None,
+    # FCM endpoint to send to, defaults to pyfcm's (and so Google's)
+    "ENDPOINT": None,
+    # hours after which re-registering an unchanged device refreshes its
+    # updated_at, or None to never write for an unchanged device
+    "TOUCH_INTERVAL": 24,
+    # when a user registers a token other users have active devices with,
+    # "shared" leaves those be and "exclusive" deactivates them
+    "REGISTRATION_POLICY": "shared",
+    # most devices that can be registered by one bulk request
+    "BULK_MAX_DEVICES": 1000,
+    # max connections kept open to FCM per process and API key
+    "HTTP_POOL_SIZE": 10,
+    # enable TCP keep-alive on pooled connections so idle ones aren't dropped
+    "HTTP_KEEPALIVE": True,
+    # max requests in flight at once per event loop for async sends
+    "ASYNC_MAX_CONCURRENCY": 50,
+    # threads used to send in parallel, 0 to send one request at a time
+    "SEND_WORKERS": 0,
+    # seconds to cache each user's active devices for, or None to not cache
+    "USER_CACHE_TIMEOUT": None,
+    # which of Django's caches to use
+    "CACHE_ALIAS": "default",
+    # max requests per second to FCM per API key, or None to not limit
+    "RATE_LIMIT": None,
+    # max requests sent in a burst, defaults to RATE_LIMIT
+    "RATE_LIMIT_BURST": None,
+    # attempts made to send to a device hitting transient errors
+    "RETRY_ATTEMPTS": 3,
+    # seconds to back off before the first retry, doubling for each after
+    "RETRY_BACKOFF": 0.5,
+    # most seconds to back off before any retry
+    "RETRY_BACKOFF_MAX": 10,
+    # seconds within which repeats of a notification to a device are dropped
+    "DEDUP_WINDOW": None,
+    # dotted path to a function merging dropped repeats into the next send
+    "DEDUP_MERGE": None,
+    # seconds before a claimed outbox row is assumed abandoned and reclaimed
+    "OUTBOX_LEASE": 300,
+    # seconds before retrying an outbox row that hit a transient error
+    "OUTBOX_RETRY_DELAY": 60,
+    # attempts made to send an outbox row before it's marked failed
+    "OUTBOX_MAX_ATTEMPTS": 5,
+    # dotted path to a MetricsSink class, see fcm_devices.metrics
+    "METRICS_SINK": None,
+    # median seconds each request to FakeFCMBackend takes
+    "FAKE_LATENCY": 0,
+    # spread of FakeFCMBackend's log-normal latencies, 0 for constant
+    "FAKE_LATENCY_SIGMA": 0.5,
+    # fraction of tokens FakeFCMBackend fails with each error code
+    "FAKE_ERROR_RATES": {},
+    # fraction of successful tokens FakeFCMBackend returns a canonical id for
+    "FAKE_CANONICAL_RATE": 0,
+    # seed FakeFCMBackend's randomness for repeatable runs
+    "FAKE_SEED": None,
+    # max ids per batched UPDATE or DELETE statement
+    "DB_BATCH_SIZE": 500,
 }
 
 
 app_settings = AppSettings("FCM_DEVICES", DEFAULTS)
+
+
+@receiver(setting_changed)
+def reload_app_settings(setting, **kwargs):
+    if setting.startswith(f"{app_settings.prefix}_"):
+        app_settings.reload()
@@ -7,3 +7,19 @@ device_created = Signal(providing_args=["device"])
 
 # fired any time a device is updated
 device_updated = Signal(providing_args=["device"])
+
+
+# fired once per batch of devices created by a bulk registration
+devices_created = Signal(providing_args=["devices"])
+
+
+# fired once per batch of devices updated by a bulk registration
+devices_updated = Signal(providing_args=["devices"])
+
+
+# fired once per batch of devices deactivated due to FCM errors
+devices_deactivated = Signal(providing_args=["device_ids"])
+
+
+# fired once per id range of devices deleted or deactivated by pruning
+devices_pruned = Signal(providing_args=["device_ids", "user_ids", "deleted"])
@@ -0,0 +1,24 @@
+from itertools import islice
+
+
+def chunked(iterable, size):
+    """Yield successive lists of at most `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def unique_by_token(devices):
+    """
+    Yield devices skipping any with a token already yielded, remembering only
+    the hash of each token.
+    """
+    seen = set()
+    for device in devices:
+        key = hash(device.token)
+        if key not in seen:
+            seen.add(key)
+            yield device
@@ -23,6 +23,11 @@ install_requires = [
     "django-konst>=2,<3",
 ]
 
+extras_require = {
+    # needed by AsyncFCMBackend
+    "async": ["aiohttp>=3.6,<4"],
+}
+
 tests_require = [
     "pytest>=4,<5",
     "pytest-django>=3,<4",
@@ -52,6 +57,7 @@ setup(
         "Framework :: Django",
     ],
     install_requires=install_requires,
+    extras_require=extras_require,
     test_suite="runtests.runtests",
     tests_require=tests_require,
     zip_safe=False,
@@ -0,0 +1,312 @@
+"""
+Benchmarks for sending notifications and registering devices, against a local
+fake FCM server with configurable latency and errors.
+
+Run from the repository root, optionally saving the results:
+
+    python -m tests.benchmarks --sizes 1000,10000 --latency 20 --output new.json
+
+Results are JSON, and passing an earlier run as `--baseline` prints how the
+p50 and p99 latency and throughput of each benchmark have changed.
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000",
+        help="Comma separated device table sizes to benchmark at",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=200,
+        help="Sends or registrations to time per benchmark",
+    )
+    parser.add_argument(
+        "--bulk-iterations",
+        type=int,
+        default=3,
+        help="Fan-outs to the whole table to time per size",
+    )
+    parser.add_argument(
+        "--devices-per-user", type=int, default=5, help="Devices each user has"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Milliseconds FCM takes to respond"
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0,
+        help="Up to this many more milliseconds FCM takes to respond, at random",
+    )
+    parser.add_argument(
+        "--error",
+        action="append",
+        default=[],
+        metavar="CODE=FRACTION",
+        help="Fail this fraction of tokens with an FCM error code, ie - NotRegistered=0.01",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=0, help="FCM_DEVICES_SEND_WORKERS to use"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="File to write results to, or stdout")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    args.error_mix = {}
+    for error in args.error:
+        code, fraction = error.split("=")
+        args.error_mix[code] = float(fraction)
+    return args
+
+
+def summarise(name, table_size, timings, elapsed, items):
+    from fcm_devices.metrics import percentile
+
+    timings = sorted(timings)
+    return {
+        "name": name,
+        "table_size": table_size,
+        "iterations": len(timings),
+        "p50_ms": round(percentile(timings, 50) * 1000, 3),
+        "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        "mean_ms": round(sum(timings) / len(timings) * 1000, 3),
+        # notifications sent, or devices registered, per second
+        "throughput": round(items / elapsed, 1),
+    }
+
+
+def measure(name, table_size, operations, items_per_operation=1):
+    """Time calling each of `operations` in turn."""
+    timings = []
+    started = time.perf_counter()
+    for operation in operations:
+        before = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - started
+    result = summarise(
+        name, table_size, timings, elapsed, len(timings) * items_per_operation
+    )
+    print(
+        f"{name} @ {table_size}: p50 {result['p50_ms']}ms, "
+        f"p99 {result['p99_ms']}ms, {result['throughput']}/s",
+        file=sys.stderr,
+    )
+    return result
+
+
+def populate(size, devices_per_user):
+    """Replace the device table with `size` devices, returning their users."""
+    from django.contrib.auth.models import User
+
+    from fcm_devices.models import Device, hash_token
+
+    Device.objects.all().delete()
+    User.objects.all().delete()
+    User.objects.bulk_create(
+        [User(username=f"user-{i}") for i in range(-(-size // devices_per_user))],
+        batch_size=500,
+    )
+    # not every database returns the ids of bulk created rows
+    users = list(User.objects.order_by("id"))
+    devices = []
+    for i in range(size):
+        token = f"token-{i}"
+        devices.append(
+            Device(
+                user=users[i // devices_per_user],
+                name="Benchmark phone",
+                type=random.choice(["ios", "android"]),
+                token=token,
+                token_hash=hash_token(token),
+            )
+        )
+    Device.objects.bulk_create(devices, batch_size=500)
+    return users
+
+
+def run(args):
+    from django.urls import reverse
+
+    from rest_framework.test import APIClient
+
+    from fcm_devices import service
+    from fcm_devices.models import Device
+
+    results = []
+    for size in args.sizes:
+        random.seed(args.seed)
+        users = populate(size, args.devices_per_user)
+        devices = list(Device.objects.all())
+        picks = [random.randrange(size) for _ in range(args.iterations)]
+
+        results.append(
+            measure(
+                "send_notification",
+                size,
+                [
+                    lambda i=i: service.send_notification(
+                        devices[i], message_body="Benchmark"
+                    )
+                    for i in picks
+                ],
+            )
+        )
+        results.append(
+            measure(
+                "send_notification_to_user",
+                size,
+                [
+                    lambda i=i: service.send_notification_to_user(
+                        users[i // args.devices_per_user], message_body="Benchmark"
+                    )
+                    for i in picks
+                ],
+                items_per_operation=args.devices_per_user,
+            )
+        )
+
+        def send_bulk():
+            service.send_notification_bulk(
+                Device.objects.filter(active=True), message_body="Benchmark"
+            )
+
+        results.append(
+            measure(
+                "send_notification_bulk",
+                size,
+                [send_bulk] * args.bulk_iterations,
+                items_per_operation=size,
+            )
+        )
+
+        client = APIClient()
+        url = reverse("devices-list")
+
+        def register(i, token):
+            client.force_authenticate(users[i // args.devices_per_user])
+            response = client.post(
+                url,
+                {
+                    "name": "Benchmark phone",
+                    "active": True,
+                    "type": "ios",
+                    "token": token,
+                },
+            )
+            assert response.status_code == 201, response.content
+
+        results.append(
+            measure(
+                "register_new_device",
+                size,
+                [
+                    lambda n=n, i=i: register(i, f"new-token-{n}")
+                    for n, i in enumerate(picks)
+                ],
+            )
+        )
+        results.append(
+            measure(
+                "register_existing_device",
+                size,
+                [lambda i=i: register(i, devices[i].token) for i in picks],
+            )
+        )
+    return results
+
+
+def compare(results, baseline):
+    """Print how each result has changed from the same one in `baseline`."""
+    previous = {(r["name"], r["table_size"]): r for r in baseline["results"]}
+    for result in results:
+        before = previous.get((result["name"], result["table_size"]))
+        if before is None:
+            continue
+        changes = ", ".join(
+            f"{key} {(result[key] - before[key]) / before[key]:+.1%}"
+            for key in ("p50_ms", "p99_ms", "throughput")
+            if before[key]
+        )
+        print(f"{result['name']} @ {result['table_size']}: {changes}", file=sys.stderr)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    import django
+
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import (
+        override_settings,
+        setup_test_environment,
+        teardown_test_environment,
+    )
+
+    from .fake_fcm import FakeFCMServer
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    fake_fcm = FakeFCMServer(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_mix=args.error_mix,
+        seed=args.seed,
+        record=False,
+    )
+    try:
+        with fake_fcm, override_settings(
+            FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend",
+            FCM_DEVICES_ENDPOINT=fake_fcm.url,
+            FCM_DEVICES_SEND_WORKERS=args.workers,
+        ):
+            results = run(args)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    output = {
+        "environment": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+        },
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("error", "output", "baseline")
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
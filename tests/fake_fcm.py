@@ -0,0 +1,104 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import random
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeFCMServer(object):
+    """
+    A local stand-in for the FCM legacy HTTP endpoint.
+
+    Every token is sent successfully unless found in `errors`, in which case
+    it fails with the error code given for it. Use as a context manager, and
+    point `FCM_DEVICES_ENDPOINT` at `url`.
+
+    For benchmarks, each response can be delayed by `latency` seconds plus up
+    to `jitter` more, and other tokens failed at random according to
+    `error_mix`, a mapping of error code to the fraction of tokens to fail
+    with it. Set `record` to False to not keep every payload received.
+    """
+
+    def __init__(
+        self, errors=None, latency=0, jitter=0, error_mix=None, seed=None, record=True
+    ):
+        self.errors = errors or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_mix = error_mix or {}
+        self.record = record
+        self.payloads = []
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/fcm/send"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, payload):
+        tokens = payload.get("registration_ids") or [payload["to"]]
+        with self._lock:
+            if self.record:
+                self.payloads.append(payload)
+            self.requests += 1
+            multicast_id = self.requests
+            errors = [self.error_for(token) for token in tokens]
+            delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        results = [
+            {"error": error} if error else {"message_id": f"0:{multicast_id}:{token}"}
+            for token, error in zip(tokens, errors)
+        ]
+        failure = sum(1 for result in results if "error" in result)
+        return {
+            "multicast_id": multicast_id,
+            "success": len(tokens) - failure,
+            "failure": failure,
+            "canonical_ids": 0,
+            "results": results,
+        }
+
+    def error_for(self, token):
+        if token in self.errors:
+            return self.errors[token]
+        roll = self._random.random()
+        for error, fraction in self.error_mix.items():
+            if roll < fraction:
+                return error
+            roll -= fraction
+        return None
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                body = json.dumps(fake.respond(json.loads(self.rfile.read(length))))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
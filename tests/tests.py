@@ -1,18 +1,45 @@
+from datetime import timedelta
+import importlib
 import json
+import queue
+import threading
 
+from django.apps import apps as django_apps
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
 from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
 
+from asgiref.sync import async_to_sync
 from model_bakery import baker
+from pyfcm.errors import FCMServerError
 from pyfcm.fcm import FCMNotification
 import pytest
 import responses
 from rest_framework.test import APIClient
 
-from fcm_devices import service
+from fcm_devices import dedup, fcm, outbox, service
 from fcm_devices.api.drf.serializers import DeviceSerializer
-from fcm_devices.models import Device
+from fcm_devices.broadcast import (
+    Broadcast,
+    BroadcastError,
+    CheckpointError,
+    partition,
+    read_user_ids,
+)
+from fcm_devices.cache import user_device_cache as device_cache
+from fcm_devices.coalesce import CoalesceSendsMiddleware, coalesce_sends
+from fcm_devices.metrics import get_metrics
+from fcm_devices.models import Device, NotificationOutbox
+from fcm_devices.prune import prune_devices
+from fcm_devices.ratelimit import RateLimiter, parse_retry_after
+from fcm_devices.settings import app_settings
+
+from . import benchmarks
+from .fake_fcm import FakeFCMServer
 
 
 @pytest.fixture()
@@ -20,6 +47,25 @@ def api_client():
     return APIClient()
 
 
+@pytest.fixture()
+def fake_fcm():
+    with FakeFCMServer() as server:
+        with override_settings(FCM_DEVICES_ENDPOINT=server.url):
+            yield server
+
+
+def run_async(coroutine_function, *args, **kwargs):
+    """Run an async service function, closing any async clients it opened."""
+
+    async def run():
+        try:
+            return await coroutine_function(*args, **kwargs)
+        finally:
+            await fcm.async_client_pool.close()
+
+    return async_to_sync(run)()
+
+
 # tests for service logic
 
 success_response = {
@@ -52,6 +98,40 @@ configuration_error_response = {
 }
 
 
+def multicast_callback(errors, canonical=None):
+    """
+    Build a `responses` callback answering a multicast request, failing any
+    token found in `errors` with the error given for it, and giving any found
+    in `canonical` the canonical registration id given for it.
+    """
+    canonical = canonical or {}
+
+    def callback(request):
+        payload = json.loads(request.body)
+        tokens = payload.get("registration_ids") or [payload["to"]]
+        results = []
+        for token in tokens:
+            if token in errors:
+                results.append({"error": errors[token]})
+            elif token in canonical:
+                results.append(
+                    {"message_id": token, "registration_id": canonical[token]}
+                )
+            else:
+                results.append({"message_id": token})
+        failure = sum(1 for result in results if "error" in result)
+        body = {
+            "multicast_id": len(responses.calls) + 1,
+            "success": len(tokens) - failure,
+            "failure": failure,
+            "canonical_ids": sum(1 for token in tokens if token in canonical),
+            "results": results,
+        }
+        return (200, {}, json.dumps(body))
+
+    return callback
+
+
 @pytest.mark.django_db
 def test_update_or_create_device_create(mocker):
     user = baker.make("auth.User")
@@ -108,6 +188,131 @@ def test_update_or_create_device_update(mocker):
     assert not device_created_signal.called
 
 
+@pytest.mark.django_db
+def test_update_or_create_device_unchanged(mocker, django_assert_num_queries):
+    user = baker.make("auth.User")
+    device = Device.objects.create(
+        user=user,
+        token="iamfcmroar",
+        active=True,
+        type=Device.types.android,
+        name="Pixel 2",
+    )
+    initial_updated_at = device.updated_at
+    device_updated_signal = mocker.patch(
+        "fcm_devices.service.signals.device_updated.send"
+    )
+    kwargs = dict(
+        user=user,
+        token="iamfcmroar",
+        active=True,
+        _type=Device.types.android,
+        name="Pixel 2",
+    )
+    # a read and nothing else
+    with django_assert_num_queries(1):
+        unchanged, created = service.update_or_create_device(**kwargs)
+    assert unchanged == device
+    assert not created
+    assert unchanged.updated_at == initial_updated_at
+
+    # once the touch interval has passed updated_at is refreshed
+    Device.objects.filter(pk=device.pk).update(
+        updated_at=initial_updated_at - timedelta(hours=25)
+    )
+    with django_assert_num_queries(2):
+        touched, _ = service.update_or_create_device(**kwargs)
+    device.refresh_from_db()
+    assert device.updated_at == touched.updated_at > initial_updated_at
+    assert not device_updated_signal.called
+
+    with override_settings(FCM_DEVICES_TOUCH_INTERVAL=None):
+        Device.objects.filter(pk=device.pk).update(
+            updated_at=initial_updated_at - timedelta(days=365)
+        )
+        with django_assert_num_queries(1):
+            service.update_or_create_device(**kwargs)
+
+
+@pytest.mark.django_db
+def test_registration_policy(mocker):
+    old_owner, new_owner = baker.make("auth.User", _quantity=2)
+    old_device = baker.make(
+        "fcm_devices.Device", user=old_owner, token="shared", active=True
+    )
+    deactivated_signal = mocker.patch("fcm_devices.fcm.devices_deactivated.send")
+    kwargs = dict(token="shared", active=True, _type=Device.types.ios, name="Phone")
+
+    # by default both users keep their device
+    service.update_or_create_device(user=new_owner, **kwargs)
+    assert Device.objects.by_token("shared").filter(active=True).count() == 2
+
+    with override_settings(FCM_DEVICES_REGISTRATION_POLICY="exclusive"):
+        service.bulk_update_or_create_devices(
+            new_owner,
+            [
+                {"token": "shared", "active": True, "type": "android", "name": "P"},
+                {"token": "other", "active": True, "type": "ios", "name": "Phone"},
+            ],
+        )
+        old_device.refresh_from_db()
+        assert not old_device.active
+        deactivated_signal.assert_called_once_with(
+            sender=Device, device_ids=[old_device.id]
+        )
+
+        # registering it back deactivates the other user's device in turn
+        service.update_or_create_device(user=old_owner, **kwargs)
+        assert list(
+            Device.objects.by_token("shared")
+            .filter(active=True)
+            .values_list("user", flat=True)
+        ) == [old_owner.id]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("supports_upsert", [True, False])
+def test_device_upsert(
+    mocker, django_assert_num_queries, django_assert_max_num_queries, supports_upsert
+):
+    def queries():
+        # a single statement, or whatever update_or_create takes
+        if supports_upsert:
+            return django_assert_num_queries(1)
+        return django_assert_max_num_queries(10)
+
+    mocker.patch(
+        "fcm_devices.models.DeviceManager.supports_upsert",
+        return_value=supports_upsert,
+    )
+    user = baker.make("auth.User")
+    with queries():
+        device, created = Device.objects.upsert(
+            user=user,
+            token="iamfcmroar",
+            active=True,
+            type=Device.types.android,
+            name="Pixel 2",
+        )
+    assert created
+    assert device == Device.objects.get()
+
+    with queries():
+        updated, created = Device.objects.upsert(
+            user=user,
+            token="iamfcmroar",
+            active=False,
+            type=Device.types.android,
+            name="Pixel 3",
+        )
+    assert not created
+    assert updated.pk == device.pk
+    assert updated.created_at == device.created_at
+    stored = Device.objects.get()
+    assert (stored.name, stored.active) == ("Pixel 3", False)
+    assert stored.updated_at == updated.updated_at > device.updated_at
+
+
 @pytest.mark.django_db
 def test_device_model_str(mocker):
     user = baker.make("auth.User", first_name="Ringo")
@@ -121,6 +326,66 @@ def test_device_model_str(mocker):
     assert str(device) == f"{user} on android w/ token iamfcmroar..."
 
 
+@pytest.mark.django_db
+def test_device_by_token():
+    shared = [baker.make("fcm_devices.Device", token="shared-token") for _ in range(2)]
+    other = baker.make("fcm_devices.Device", token="other-token")
+    baker.make("fcm_devices.Device", token="unwanted-token")
+    assert set(Device.objects.by_token("shared-token")) == set(shared)
+    assert set(Device.objects.by_tokens(["shared-token", "other-token"])) == {
+        *shared,
+        other,
+    }
+
+    # the digest follows the token through saves
+    other.token = "new-token"
+    other.save(update_fields=["token"])
+    assert list(Device.objects.by_token("new-token")) == [other]
+    assert not Device.objects.by_token("other-token").exists()
+
+    # and upserts
+    upserted, _ = Device.objects.upsert(
+        user=other.user, token="upserted", active=True, type="ios", name="Pixel"
+    )
+    assert list(Device.objects.by_token("upserted")) == [upserted]
+
+
+@pytest.fixture()
+def query_plan():
+    """Return the query plan for a queryset, discouraging sequential scans."""
+    if connection.vendor not in ("postgresql", "sqlite"):
+        pytest.skip("query plans are only checked on PostgreSQL and SQLite")
+    if connection.vendor == "postgresql":
+        # our test tables are tiny, so would otherwise always be scanned
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+    return lambda queryset: queryset.explain()
+
+
+@pytest.mark.django_db
+def test_active_device_indexes_used(query_plan):
+    user = baker.make("auth.User")
+    baker.make("fcm_devices.Device", user=user, active=True)
+    baker.make("fcm_devices.Device", user=user, active=False)
+    assert "fcm_device_user_active_idx" in query_plan(
+        Device.objects.filter(user=user, active=True)
+    )
+    assert "fcm_device_type_active_idx" in query_plan(
+        Device.objects.filter(type=Device.types.ios, active=True)
+    )
+
+
+@pytest.mark.django_db
+def test_backfill_token_hashes(mocker):
+    migration = importlib.import_module("fcm_devices.migrations.0002_device_token_hash")
+    mocker.patch.object(migration, "BATCH_SIZE", 2)
+    devices = baker.make("fcm_devices.Device", _quantity=5)
+    Device.objects.update(token_hash="")
+    migration.backfill_token_hashes(django_apps, mocker.Mock(connection=connection))
+    for device in devices:
+        assert list(Device.objects.by_token(device.token)) == [device]
+
+
 @responses.activate
 @pytest.mark.django_db
 @override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
@@ -223,6 +488,1275 @@ def test_send_notification_to_user_has_multiple_devices(mocker):
     )
 
 
+def test_fcm_backend_and_settings_memoized(mocker):
+    import_string = mocker.patch(
+        "fcm_devices.fcm.import_string", wraps=fcm.import_string
+    )
+    with override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend"):
+        backend = service.get_fcm_backend()
+        assert type(backend) is fcm.FCMBackend
+        assert service.get_fcm_backend() is backend
+        assert import_string.call_count == 1
+        assert app_settings.__dict__["BACKEND_CLASS"] == "fcm_devices.fcm.FCMBackend"
+
+        with override_settings(
+            FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.AsyncFCMBackend"
+        ):
+            assert app_settings.BACKEND_CLASS == "fcm_devices.fcm.AsyncFCMBackend"
+            assert type(service.get_fcm_backend()) is fcm.AsyncFCMBackend
+
+        assert app_settings.BACKEND_CLASS == "fcm_devices.fcm.FCMBackend"
+        assert service.get_fcm_backend() is not backend
+
+
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_fcm_backend_reuses_pooled_client():
+    backend = service.get_fcm_backend()
+    client = backend.get_client()
+    assert service.get_fcm_backend().get_client() is client
+    adapter = client.requests_session.get_adapter(FCMNotification.FCM_END_POINT)
+    assert isinstance(adapter, fcm.KeepAliveHTTPAdapter)
+
+    # other threads get their own client, but share the connection pool
+    thread_clients = []
+    thread = threading.Thread(
+        target=lambda: thread_clients.append(backend.get_client())
+    )
+    thread.start()
+    thread.join()
+    assert thread_clients[0] is not client
+    assert (
+        thread_clients[0].requests_session.get_adapter(FCMNotification.FCM_END_POINT)
+        is adapter
+    )
+
+
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_fcm_client_pool_rebuilt_on_settings_change_and_fork(mocker):
+    backend = service.get_fcm_backend()
+    client = backend.get_client()
+    with override_settings(FCM_DEVICES_HTTP_POOL_SIZE=2):
+        resized_client = backend.get_client()
+        assert resized_client is not client
+        adapter = resized_client.requests_session.get_adapter(
+            FCMNotification.FCM_END_POINT
+        )
+        assert adapter._pool_maxsize == 2
+
+        mocker.patch("fcm_devices.fcm.os.getpid", return_value=-1)
+        assert backend.get_client() is not resized_client
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_send_notification_bulk(mocker):
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback({"token-1": "NotRegistered"}),
+    )
+    mocker.patch("fcm_devices.fcm.FCMBackend.max_recipients", 2)
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+        for i in range(5)
+    ]
+    result = service.send_notification_bulk(
+        Device.objects.order_by("id"), message_title="Test title"
+    )
+    # 5 tokens in chunks of 2
+    assert len(responses.calls) == 3
+    assert result.multicast_ids == [1, 2, 3]
+    assert result.success == 4
+    assert result.failure == 1
+    assert [device for device, _ in result.results] == devices
+    assert result.results[1][1] == {"error": "NotRegistered"}
+    assert result.error_counts == {"NotRegistered": 1}
+    assert list(
+        Device.objects.filter(active=False).values_list("token", flat=True)
+    ) == ["token-1"]
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_send_notification_bulk_sends_shared_tokens_once():
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback({}),
+    )
+    first, _, other = [
+        baker.make("fcm_devices.Device", token=token, active=True)
+        for token in ("token-1", "token-1", "token-2")
+    ]
+    result = service.send_notification_bulk(
+        Device.objects.order_by("id"), message_body="Hi"
+    )
+    sent = json.loads(responses.calls[0].request.body)
+    assert sent["registration_ids"] == ["token-1", "token-2"]
+    assert [device for device, _ in result.results] == [first, other]
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend",
+    FCM_DEVICES_DB_BATCH_SIZE=2,
+    FCM_DEVICES_RETRY_ATTEMPTS=1,
+)
+def test_send_notification_bulk_deactivates_in_batches(
+    mocker, django_assert_num_queries
+):
+    errors = {
+        "token-0": "NotRegistered",
+        "token-2": "InvalidRegistration",
+        "token-3": "NotRegistered",
+        "token-4": "Unavailable",
+    }
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback(errors),
+    )
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+        for i in range(5)
+    ]
+    device_updated_signal = mocker.patch("fcm_devices.fcm.device_updated.send")
+    devices_deactivated_signal = mocker.patch(
+        "fcm_devices.fcm.devices_deactivated.send"
+    )
+    # three ids to deactivate in batches of two
+    with django_assert_num_queries(2):
+        result = service.get_fcm_backend().send_bulk(devices)
+    deactivated_ids = [devices[0].id, devices[2].id, devices[3].id]
+    assert result.deactivated == deactivated_ids
+    assert set(Device.objects.filter(active=False).values_list("id", flat=True)) == set(
+        deactivated_ids
+    )
+    devices_deactivated_signal.assert_called_once_with(
+        sender=Device, device_ids=deactivated_ids
+    )
+    assert not device_updated_signal.called
+
+
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.AsyncFCMBackend",
+    FCM_DEVICES_ASYNC_MAX_CONCURRENCY=2,
+)
+def test_asend_notification_bulk(fake_fcm, mocker):
+    fake_fcm.errors = {"token-3": "NotRegistered"}
+    mocker.patch("fcm_devices.fcm.FCMBackend.max_recipients", 2)
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+        for i in range(5)
+    ]
+    result = run_async(
+        service.asend_notification_bulk,
+        Device.objects.order_by("id"),
+        message_title="Test title",
+    )
+    assert len(fake_fcm.payloads) == 3
+    assert all(
+        payload["notification"]["title"] == "Test title"
+        for payload in fake_fcm.payloads
+    )
+    assert sorted(result.multicast_ids) == [1, 2, 3]
+    assert result.success == 4
+    assert result.failure == 1
+    assert [device for device, _ in result.results] == devices
+    assert result.deactivated == [devices[3].id]
+    assert list(
+        Device.objects.filter(active=False).values_list("token", flat=True)
+    ) == ["token-3"]
+
+
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.AsyncFCMBackend",
+    FCM_DEVICES_RETRY_ATTEMPTS=1,
+)
+def test_asend_notification_bulk_collects_exceptions(fake_fcm, mocker):
+    fake_fcm.errors = {"token-0": "NotRegistered"}
+    mocker.patch("fcm_devices.fcm.FCMBackend.max_recipients", 2)
+    asend_multicast = fcm.AsyncFCMBackend.asend_multicast
+
+    async def fail_token_2(self, devices, **kwargs):
+        if any(device.token == "token-2" for device in devices):
+            raise FCMServerError("FCM server is temporarily unavailable")
+        return await asend_multicast(self, devices, **kwargs)
+
+    mocker.patch.object(fcm.AsyncFCMBackend, "asend_multicast", fail_token_2)
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+        for i in range(4)
+    ]
+    result = run_async(service.asend_notification_bulk, Device.objects.order_by("id"))
+    # the failing request doesn't stop the others being acted on
+    assert result.success == 1
+    assert result.deactivated == [devices[0].id]
+    [(failed_devices, exception)] = result.exceptions
+    assert failed_devices == devices[2:]
+    assert isinstance(exception, FCMServerError)
+
+    user = baker.make("auth.User")
+    Device.objects.update(user=user, active=True)
+    responses = run_async(service.asend_notification_to_user, user, message_body="Hi")
+    assert [
+        type(response) if isinstance(response, Exception) else response["success"]
+        for response in responses
+    ] == [0, 1, FCMServerError, 1]
+
+
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.AsyncFCMBackend")
+def test_asend_notification_to_user(fake_fcm, mocker):
+    user = baker.make("auth.User")
+    baker.make("fcm_devices.Device", user=user, token="good", active=True)
+    invalid = baker.make("fcm_devices.Device", user=user, token="bad", active=True)
+    baker.make("fcm_devices.Device", user=user, token="inactive", active=False)
+    fake_fcm.errors = {"bad": "InvalidRegistration"}
+    device_updated_signal = mocker.patch("fcm_devices.fcm.device_updated.send")
+    update_device_on_error = mocker.spy(fcm.AsyncFCMBackend, "update_device_on_error")
+    dedupe = mocker.spy(dedup.deduplicator, "dedupe")
+    run_async(service.asend_notification_to_user, user, message_body="Test content")
+    assert sorted(payload["to"] for payload in fake_fcm.payloads) == ["bad", "good"]
+    invalid.refresh_from_db()
+    assert not invalid.active
+    assert device_updated_signal.call_count == 1
+    # the successful send didn't need to act on errors
+    assert update_device_on_error.call_count == 1
+    # nor, without a DEDUP_WINDOW, to check for repeats
+    assert not dedupe.called
+
+
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.AsyncFCMBackend")
+def test_asend_notification_requires_aiohttp(mocker):
+    mocker.patch("fcm_devices.fcm.aiohttp", None)
+    device = baker.make("fcm_devices.Device", active=True)
+    with pytest.raises(ImproperlyConfigured, match="aiohttp is required"):
+        run_async(service.asend_notification, device, message_body="Test content")
+
+
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.AsyncFCMBackend")
+def test_asend_notification_config_error(fake_fcm):
+    device = baker.make("fcm_devices.Device", active=True)
+    fake_fcm.errors = {device.token: "MismatchSenderId"}
+    with pytest.raises(ImproperlyConfigured):
+        run_async(service.asend_notification, device, message_body="Test content")
+    device.refresh_from_db()
+    assert device.active
+
+
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend", FCM_DEVICES_SEND_WORKERS=4
+)
+def test_send_notification_to_user_parallel(fake_fcm, mocker):
+    user = baker.make("auth.User")
+    devices = [
+        baker.make("fcm_devices.Device", user=user, token=f"token-{i}", active=True)
+        for i in range(6)
+    ]
+    fake_fcm.errors = {"token-1": "NotRegistered"}
+    send_single = fcm.FCMBackend.send_single
+    update_devices_on_results = fcm.FCMBackend.update_devices_on_results
+    failure = ValueError("boom")
+    threads = []
+
+    def send_or_fail(self, device, **kwargs):
+        if device.token == "token-4":
+            raise failure
+        return send_single(self, device, **kwargs)
+
+    def update_from_thread(self, results):
+        threads.append(threading.current_thread())
+        return update_devices_on_results(self, results)
+
+    sends = mocker.patch.object(
+        fcm.FCMBackend, "send_single", autospec=True, side_effect=send_or_fail
+    )
+    mocker.patch.object(
+        fcm.FCMBackend,
+        "update_devices_on_results",
+        autospec=True,
+        side_effect=update_from_thread,
+    )
+    results = service.send_notification_to_user(user, message_body="Test content")
+
+    # everything was attempted and results are in device order
+    assert sends.call_count == 6
+    for device, result in zip(devices, results):
+        if device.token == "token-4":
+            assert result is failure
+        elif device.token == "token-1":
+            assert result["results"] == [{"error": "NotRegistered"}]
+        else:
+            assert result["results"][0]["message_id"].endswith(device.token)
+    # errors were acted on once, by the caller and within its transaction
+    assert threads == [threading.current_thread()]
+    assert list(Device.objects.filter(active=False).values_list("id", flat=True)) == [
+        devices[1].id
+    ]
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend",
+    FCM_DEVICES_RETRY_ATTEMPTS=1,
+)
+@pytest.mark.parametrize("workers", [0, 2])
+def test_send_notification_bulk_collects_exceptions(mocker, workers):
+    multicast = multicast_callback({"token-0": "NotRegistered"})
+
+    def callback(request):
+        if "token-2" in json.loads(request.body)["registration_ids"]:
+            return (500, {}, "")
+        return multicast(request)
+
+    responses.add_callback(
+        responses.POST, FCMNotification.FCM_END_POINT, callback=callback
+    )
+    mocker.patch("fcm_devices.fcm.FCMBackend.max_recipients", 2)
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+        for i in range(6)
+    ]
+    with override_settings(FCM_DEVICES_SEND_WORKERS=workers):
+        result = service.send_notification_bulk(devices)
+    # a failing request doesn't stop the others, in parallel or not
+    assert len(responses.calls) == 3
+    assert [device.token for device, _ in result.results] == [
+        "token-0",
+        "token-1",
+        "token-4",
+        "token-5",
+    ]
+    assert result.success == 3
+    assert result.failure == 1
+    assert result.deactivated == [devices[0].id]
+    [(failed_devices, exception)] = result.exceptions
+    assert failed_devices == devices[2:4]
+    assert isinstance(exception, FCMServerError)
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_send_notification_bulk_retries_failed_devices(mocker):
+    # token-1 recovers on the second attempt, token-2 never does
+    errors = {"token-1": "Unavailable", "token-2": "InternalServerError"}
+    multicast = multicast_callback(errors)
+
+    def callback(request):
+        if len(responses.calls) == 1:
+            del errors["token-1"]
+        return multicast(request)
+
+    responses.add_callback(
+        responses.POST, FCMNotification.FCM_END_POINT, callback=callback
+    )
+    sleep = mocker.patch("fcm_devices.fcm.time.sleep")
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+        for i in range(3)
+    ]
+    result = service.send_notification_bulk(devices)
+
+    sent = [json.loads(call.request.body) for call in responses.calls]
+    assert sent[0]["registration_ids"] == ["token-0", "token-1", "token-2"]
+    assert sent[1]["registration_ids"] == ["token-1", "token-2"]
+    assert sent[2]["to"] == "token-2"
+    assert sleep.call_count == 2
+    assert all(0 <= delay <= 1 for ((delay,), _) in sleep.call_args_list)
+    assert result.multicast_ids == [1, 2, 3]
+    assert result.success == 2
+    assert result.failure == 1
+    assert [result for _, result in result.results] == [
+        {"message_id": "token-0"},
+        {"message_id": "token-1"},
+        {"error": "InternalServerError"},
+    ]
+    assert result.exhausted == [devices[2]]
+    assert result.deactivated == []
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend", FCM_DEVICES_RETRY_ATTEMPTS=2
+)
+def test_send_notification_retries_server_errors(mocker):
+    responses.add(responses.POST, FCMNotification.FCM_END_POINT, status=500)
+    responses.add(responses.POST, FCMNotification.FCM_END_POINT, json=success_response)
+    mocker.patch("fcm_devices.fcm.time.sleep")
+    device = baker.make("fcm_devices.Device", active=True)
+
+    assert service.send_notification(device, message_body="Test") == success_response
+    assert len(responses.calls) == 2
+
+    responses.reset()
+    responses.add(responses.POST, FCMNotification.FCM_END_POINT, status=500)
+    with pytest.raises(FCMServerError):
+        service.send_notification(device, message_body="Test")
+
+    # no fewer than one attempt is made
+    responses.reset()
+    responses.add(responses.POST, FCMNotification.FCM_END_POINT, json=success_response)
+    with override_settings(FCM_DEVICES_RETRY_ATTEMPTS=0):
+        assert service.send_notification(device, message_body="Test") == (
+            success_response
+        )
+        assert len(responses.calls) == 1
+        with pytest.raises(ValueError):
+            fcm.RetryBatch([device]).response()
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+@pytest.mark.parametrize("batch_size", [1, 500])
+def test_send_notification_bulk_rewrites_canonical_tokens(mocker, batch_size):
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback(
+            {}, canonical={"token-0": "new-0", "token-1": "token-2", "token-3": "new-0"}
+        ),
+    )
+    user, other_user = baker.make("auth.User", _quantity=2)
+    devices = [
+        baker.make("fcm_devices.Device", user=user, token="token-0", active=True),
+        # token-2 is already registered for this user
+        baker.make("fcm_devices.Device", user=user, token="token-1", active=True),
+        baker.make("fcm_devices.Device", user=user, token="token-2", active=True),
+        # but new-0 is fine for another user
+        baker.make("fcm_devices.Device", user=other_user, token="token-3", active=True),
+    ]
+    devices_updated_signal = mocker.patch("fcm_devices.fcm.devices_updated.send")
+    devices_deactivated_signal = mocker.patch(
+        "fcm_devices.fcm.devices_deactivated.send"
+    )
+    with override_settings(FCM_DEVICES_DB_BATCH_SIZE=batch_size):
+        result = service.send_notification_bulk(
+            Device.objects.filter(id__in=[d.id for d in devices]).order_by("id"),
+            message_body="Hi",
+        )
+    assert result.canonical_ids == 3
+    assert result.deactivated == [devices[1].id]
+    devices_deactivated_signal.assert_called_once_with(
+        sender=Device, device_ids=[devices[1].id]
+    )
+    [(_, kwargs)] = devices_updated_signal.call_args_list
+    assert [device.id for device in kwargs["devices"]] == [devices[0].id, devices[3].id]
+    assert list(Device.objects.order_by("id").values_list("token", "active")) == [
+        ("new-0", True),
+        ("token-1", False),
+        ("token-2", True),
+        ("new-0", True),
+    ]
+    assert Device.objects.by_token("new-0").count() == 2
+
+    # and for single sends
+    responses.calls.reset()
+    device = baker.make("fcm_devices.Device", token="token-1", active=True)
+    service.send_notification(device, message_body="Hi")
+    assert device.token == Device.objects.get(id=device.id).token == "token-2"
+
+
+@pytest.mark.django_db
+def test_canonical_token_registered_meanwhile(mocker):
+    user = baker.make("auth.User")
+    devices = [
+        baker.make("fcm_devices.Device", user=user, token=f"token-{i}", active=True)
+        for i in range(3)
+    ]
+    baker.make("fcm_devices.Device", user=user, token="taken", active=True)
+    # registered after we looked for devices with the canonical tokens
+    mocker.patch.object(Device.objects, "by_tokens", return_value=Device.objects.none())
+    duplicates = fcm.FCMBackend().update_canonical_tokens(
+        [(devices[0], "new-0"), (devices[1], "taken"), (devices[2], "new-2")]
+    )
+    # only the device whose token was taken is a duplicate
+    assert duplicates == [devices[1].id]
+    assert devices[1].token == "token-1"
+    assert [device.token for device in (devices[0], devices[2])] == ["new-0", "new-2"]
+    assert list(
+        Device.objects.filter(id__in=[d.id for d in devices])
+        .order_by("id")
+        .values_list("token", flat=True)
+    ) == ["new-0", "token-1", "new-2"]
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_send_notification_to_queryset(mocker, django_assert_num_queries):
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback({"token-3": "NotRegistered"}),
+    )
+    mocker.patch("fcm_devices.fcm.FCMBackend.max_recipients", 2)
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=i != 1, type="ios")
+        for i in range(6)
+    ]
+    baker.make("fcm_devices.Device", token="token-android", type="android")
+    # another user's device with the same token isn't sent to again
+    baker.make("fcm_devices.Device", token="token-4", type="ios", active=True)
+
+    # two queries per page of two, to fetch it and check for tokens already
+    # sent to, and one to deactivate
+    with django_assert_num_queries(8):
+        result = service.send_notification_to_queryset(
+            Device.objects.filter(type="ios"), message_body="Hi"
+        )
+    sent = [json.loads(call.request.body) for call in responses.calls]
+    assert sent[0]["registration_ids"] == ["token-0", "token-2"]
+    assert sent[1]["registration_ids"] == ["token-3", "token-4"]
+    assert sent[2]["to"] == "token-5"
+    assert result.success == 4
+    assert result.failure == 1
+    assert result.error_counts == {"NotRegistered": 1}
+    assert result.deactivated == [devices[3].id]
+    # per-device results aren't kept
+    assert result.results == []
+
+    responses.calls.reset()
+    result = async_to_sync(service.asend_notification_to_queryset)(
+        Device.objects.filter(type="ios"), message_body="Hi"
+    )
+    assert result.success == 4
+    assert len(responses.calls) == 2
+
+
+@pytest.fixture()
+def user_device_cache():
+    with override_settings(FCM_DEVICES_USER_CACHE_TIMEOUT=60):
+        cache.clear()
+        device_cache.reset_stats()
+        yield device_cache
+
+
+@pytest.mark.django_db
+def test_user_device_cache(user_device_cache, mocker, django_assert_num_queries):
+    user = baker.make("auth.User")
+    active_device = baker.make("fcm_devices.Device", user=user, active=True)
+    baker.make("fcm_devices.Device", user=user, active=False)
+    mocked_send_notification = mocker.patch("fcm_devices.service.send_notification")
+
+    service.send_notification_to_user(user, message_body="Test content")
+    with django_assert_num_queries(0):
+        service.send_notification_to_user(user, message_body="Test content")
+    assert user_device_cache.stats() == {"hits": 1, "misses": 1}
+    assert mocked_send_notification.call_count == 2
+    [cached_device], _ = mocked_send_notification.call_args
+    assert cached_device == active_device
+    assert (cached_device.token, cached_device.type) == (
+        active_device.token,
+        active_device.type,
+    )
+
+    # registering a new device invalidates the user's entry
+    service.update_or_create_device(
+        user=user, token="new", active=True, _type="ios", name="Pixel"
+    )
+    assert len(user_device_cache.get_devices(user)) == 2
+    assert user_device_cache.stats() == {"hits": 1, "misses": 2}
+
+    # as does deactivating one
+    service.get_fcm_backend().deactivate_devices([active_device.id])
+    assert [device.token for device in user_device_cache.get_devices(user)] == ["new"]
+    assert user_device_cache.stats() == {"hits": 1, "misses": 3}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_user_device_cache_invalidated_on_commit(user_device_cache):
+    user = baker.make("auth.User")
+    device = baker.make("fcm_devices.Device", user=user, active=True)
+    assert user_device_cache.get_devices(user) == [device]
+    with transaction.atomic():
+        device.active = False
+        device.save()
+        # another process caches the devices as they were before we commit
+        user_device_cache.cache.set(
+            user_device_cache.key(user.pk), [(device.id, device.type, device.token)]
+        )
+    assert user_device_cache.get_devices(user) == []
+
+
+def test_rate_limiter(mocker):
+    clock = mocker.patch("fcm_devices.ratelimit.time.monotonic", return_value=100.0)
+    limiter = RateLimiter(rate=10, burst=2)
+    # a burst, then paced at the rate
+    assert [limiter.reserve() for _ in range(4)] == pytest.approx([0, 0, 0.1, 0.2])
+    clock.return_value = 101.0
+    assert limiter.reserve() == 0
+
+    # a pause holds everyone back, and halves the rate
+    limiter.pause(5)
+    assert limiter.rate == 5
+    assert limiter.reserve() == pytest.approx(5)
+    limiter.slow_down()
+    assert limiter.rate == 5
+
+    # which then recovers
+    clock.return_value = 101.0 + limiter.recovery / 4
+    limiter.slow_down()
+    assert limiter.rate == pytest.approx(7.5 / 2)
+    clock.return_value = 101.0 + limiter.recovery * 2
+    limiter.reserve()
+    assert limiter.rate == 10
+
+
+def test_parse_retry_after():
+    assert parse_retry_after({}) is None
+    assert parse_retry_after({"Retry-After": "3"}) == 3
+    assert parse_retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    assert parse_retry_after({"Retry-After": "soon"}) is None
+    with override_settings(USE_TZ=False):
+        assert parse_retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+        assert (
+            parse_retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 -0000"}) == 0
+        )
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend",
+    FCM_DEVICES_METRICS_SINK="fcm_devices.metrics.InMemoryMetrics",
+    FCM_DEVICES_RATE_LIMIT=100,
+)
+def test_send_notification_honours_retry_after(mocker):
+    responses.add(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        status=500,
+        headers={"Retry-After": "2"},
+    )
+    responses.add(responses.POST, FCMNotification.FCM_END_POINT, json=success_response)
+    sleep = mocker.patch("fcm_devices.ratelimit.time.sleep")
+    device = baker.make("fcm_devices.Device", active=True)
+    backend = service.get_fcm_backend()
+
+    assert service.send_notification(device, message_body="Test") == success_response
+    assert len(responses.calls) == 2
+    [(delay,)] = [call[0] for call in sleep.call_args_list]
+    assert delay == pytest.approx(2, abs=0.1)
+    assert backend.get_rate_limiter().rate < 100
+    # each request is timed, but not the pause between them
+    assert get_metrics().summary("fcm.send.latency")["count"] == 2
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend", FCM_DEVICES_RATE_LIMIT=100
+)
+def test_send_notification_bulk_slows_down_on_rate_errors():
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback({"token-0": "DeviceMessageRateExceeded"}),
+    )
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+        for i in range(2)
+    ]
+    service.send_notification_bulk(devices)
+    assert service.get_fcm_backend().get_rate_limiter().rate == 50
+
+
+@responses.activate
+@pytest.mark.django_db(transaction=True)
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_coalesce_sends_on_commit():
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback({}),
+    )
+    users = baker.make("auth.User", _quantity=2)
+    devices = [
+        baker.make("fcm_devices.Device", user=users[0], token="token-0"),
+        baker.make("fcm_devices.Device", user=users[0], token="token-1"),
+        baker.make("fcm_devices.Device", user=users[1], token="token-2"),
+    ]
+
+    with coalesce_sends():
+        with transaction.atomic():
+            for user in users:
+                assert (
+                    service.send_notification_to_user(user, message_body="Hi") is None
+                )
+            service.send_notification(devices[0], message_body="Hi")
+            service.send_notification(devices[0], message_body="Bye")
+            assert not responses.calls
+
+    # one multicast per payload, each device sent to once
+    assert sorted(
+        json.loads(call.request.body).get("registration_ids", ["token-0"])
+        for call in responses.calls
+    ) == [["token-0"], ["token-0", "token-1", "token-2"]]
+
+
+@responses.activate
+@pytest.mark.django_db(transaction=True)
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_coalesce_sends_dropped_on_rollback():
+    responses.add(responses.POST, FCMNotification.FCM_END_POINT, json=success_response)
+    device = baker.make("fcm_devices.Device")
+
+    def view(request):
+        with transaction.atomic():
+            service.send_notification(device, message_body="Committed")
+        try:
+            with transaction.atomic():
+                service.send_notification(device, message_body="Rolled back")
+                raise ValueError()
+        except ValueError:
+            pass
+
+    CoalesceSendsMiddleware(view)(None)
+    [call] = responses.calls
+    assert json.loads(call.request.body)["notification"]["body"] == "Committed"
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend", FCM_DEVICES_DEDUP_WINDOW=60
+)
+def test_send_notification_drops_repeats():
+    cache.clear()
+    responses.add(responses.POST, FCMNotification.FCM_END_POINT, json=success_response)
+    device, other_device = baker.make("fcm_devices.Device", _quantity=2)
+
+    assert service.send_notification(device, message_body="Hi") == success_response
+    assert service.send_notification(device, message_body="Hi") is None
+    assert service.send_notification(other_device, message_body="Hi") is not None
+    assert service.send_notification(device, message_body="Bye") is not None
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend",
+    FCM_DEVICES_DEDUP_WINDOW=60,
+    FCM_DEVICES_DEDUP_MERGE="fcm_devices.dedup.count_messages",
+)
+def test_send_notification_merges_repeats():
+    cache.clear()
+    responses.add(responses.POST, FCMNotification.FCM_END_POINT, json=success_response)
+    device = baker.make("fcm_devices.Device")
+
+    for body in ["First", "Second", "Third"]:
+        service.send_notification(device, message_body=body, collapse_key="chat")
+    assert len(responses.calls) == 1
+    # once the window has passed the next send stands for those dropped
+    cache.delete(dedup.deduplicator.key(device, {"collapse_key": "chat"}))
+    service.send_notification(device, message_body="Fourth", collapse_key="chat")
+    payload = json.loads(responses.calls[1].request.body)
+    assert payload["notification"]["body"] == "3 new messages"
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend",
+    FCM_DEVICES_METRICS_SINK="fcm_devices.metrics.InMemoryMetrics",
+    FCM_DEVICES_RETRY_ATTEMPTS=2,
+)
+def test_metrics_recorded(mocker):
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback(
+            {
+                "token-0": "NotRegistered",
+                "token-1": "NotRegistered",
+                "token-2": "Unavailable",
+            }
+        ),
+    )
+    mocker.patch("fcm_devices.fcm.time.sleep")
+    user = baker.make("auth.User")
+    service.bulk_update_or_create_devices(
+        user,
+        [
+            {"token": f"token-{i}", "active": True, "type": "ios", "name": "Phone"}
+            for i in range(4)
+        ],
+    )
+    service.send_notification_bulk(Device.objects.order_by("id"), message_body="Hi")
+
+    metrics = get_metrics()
+    assert metrics.summary("fcm.devices.upsert.latency")["count"] == 1
+    assert metrics.summary("fcm.devices.upsert.batch_size")["max"] == 4
+    assert metrics.summary("fcm.send.latency")["count"] == 2
+    assert metrics.summary("fcm.send.batch_size") == {
+        "count": 2,
+        "min": 1,
+        "max": 4,
+        "mean": 2.5,
+        "p50": 1,
+        "p99": 4,
+    }
+    assert metrics.count("fcm.send.success") == 1
+    assert metrics.count("fcm.send.failure", error="NotRegistered") == 2
+    assert metrics.count("fcm.send.failure", error="Unavailable") == 2
+    assert metrics.count("fcm.send.retries") == 1
+    assert metrics.count("fcm.devices.deactivated") == 2
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend",
+    FCM_DEVICES_METRICS_SINK="fcm_devices.metrics.LoggingMetrics",
+)
+def test_logging_metrics(caplog):
+    responses.add(
+        responses.POST, FCMNotification.FCM_END_POINT, json=unrecoverable_error_response
+    )
+    caplog.set_level("INFO", logger="fcm_devices.metrics")
+    service.send_notification(baker.make("fcm_devices.Device"), message_body="Hi")
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages[0].startswith("fcm.send.latency=")
+    assert messages[1:] == [
+        "fcm.send.batch_size=1",
+        "fcm.send.success=0",
+        "fcm.send.failure=1 error=InvalidRegistration",
+        "fcm.devices.deactivated=1",
+    ]
+
+
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FakeFCMBackend",
+    FCM_DEVICES_FAKE_LATENCY=0.05,
+    FCM_DEVICES_FAKE_ERROR_RATES={"NotRegistered": 0.2, "Unavailable": 0.1},
+    FCM_DEVICES_FAKE_CANONICAL_RATE=0.5,
+    FCM_DEVICES_FAKE_SEED=1,
+)
+def test_fake_fcm_backend(mocker):
+    sleep = mocker.patch("fcm_devices.fcm.time.sleep")
+    devices = baker.make("fcm_devices.Device", active=True, _quantity=50)
+    result = service.send_notification_bulk(devices, message_body="Hi")
+
+    stats = service.get_fcm_backend().stats()
+    # retries are simulated too
+    assert stats["requests"] > 1
+    assert stats["messages"] > 50
+    assert result.success == stats["success"] > 0
+    assert result.canonical_ids == stats["canonical_ids"] > 0
+    assert len(result.deactivated) == stats["errors"]["NotRegistered"] > 0
+    assert Device.objects.filter(active=False).count() == len(result.deactivated)
+    assert stats["errors"]["Unavailable"] > 0
+    latencies = [delay for ((delay,), _) in sleep.call_args_list]
+    assert len(set(latencies)) > 1
+
+
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_benchmarks_run():
+    args = benchmarks.parse_args(
+        ["--sizes", "10", "--iterations", "3", "--error", "NotRegistered=0.5"]
+    )
+    with FakeFCMServer(error_mix=args.error_mix, seed=0) as server:
+        with override_settings(FCM_DEVICES_ENDPOINT=server.url):
+            results = benchmarks.run(args)
+    assert server.requests
+    assert Device.objects.filter(active=False).exists()
+    assert [(r["name"], r["iterations"]) for r in results] == [
+        ("send_notification", 3),
+        ("send_notification_to_user", 3),
+        ("send_notification_bulk", 3),
+        ("register_new_device", 3),
+        ("register_existing_device", 3),
+    ]
+    assert all(r["p99_ms"] >= r["p50_ms"] > 0 for r in results)
+
+
+# tests for broadcasts
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_broadcast_command(tmp_path, mocker, capsys):
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback({"token-3": "NotRegistered"}),
+    )
+    mocker.patch("fcm_devices.fcm.FCMBackend.max_recipients", 2)
+    users = baker.make("auth.User", _quantity=2)
+    for i in range(8):
+        baker.make(
+            "fcm_devices.Device",
+            user=users[i % 2],
+            token=f"token-{i}",
+            type="ios" if i < 7 else "android",
+            active=i != 5,
+        )
+    # another user's device with a token already in the audience
+    shared = baker.make("fcm_devices.Device", token="token-1", type="ios")
+    user_ids_file = tmp_path / "users.txt"
+    user_ids_file.write_text(f"{users[1].id}\n{shared.user_id}\n")
+    checkpoint = tmp_path / "checkpoint.json"
+
+    call_command(
+        "fcm_broadcast",
+        '{"message_body": "Hi"}',
+        "--type=ios",
+        f"--user-ids-file={user_ids_file}",
+        f"--checkpoint={checkpoint}",
+        "--partitions=2",
+        "--progress-interval=0",
+    )
+    payloads = [json.loads(call.request.body) for call in responses.calls]
+    tokens = [p.get("registration_ids") or [p["to"]] for p in payloads]
+    # the second id range only has the shared token, which isn't sent to again
+    assert tokens == [["token-1", "token-3"]]
+    out = capsys.readouterr().out.splitlines()
+    assert "partitions done" in out[0]
+    assert out[-2:] == [
+        "Sent to 2 devices: 1 succeeded, 1 failed, 1 deactivated, "
+        "0 not sent due to exceptions",
+        "  NotRegistered: 1",
+    ]
+    assert not checkpoint.exists()
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_broadcast_resumes_from_checkpoint(tmp_path, mocker):
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback({}),
+    )
+    mocker.patch("fcm_devices.fcm.FCMBackend.max_recipients", 2)
+    for i in range(6):
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+    checkpoint = str(tmp_path / "checkpoint.json")
+    send_bulk = fcm.FCMBackend.send_bulk
+
+    def crash_on_second_page(self, devices, **kwargs):
+        if len(responses.calls) == 1:
+            raise KeyboardInterrupt()
+        return send_bulk(self, devices, **kwargs)
+
+    patch = mocker.patch.object(fcm.FCMBackend, "send_bulk", crash_on_second_page)
+    with pytest.raises(KeyboardInterrupt):
+        Broadcast({"message_body": "Hi"}, {}, checkpoint=checkpoint).run()
+    mocker.stop(patch)
+    with open(checkpoint) as f:
+        totals = json.load(f)["totals"]
+    assert totals["devices"] == totals["success"] == 2
+
+    with pytest.raises(CheckpointError):
+        Broadcast({"message_body": "Bye"}, {}, checkpoint=checkpoint).run()
+
+    totals, errors = Broadcast({"message_body": "Hi"}, {}, checkpoint=checkpoint).run()
+    assert totals["devices"] == totals["success"] == 6
+    assert len(responses.calls) == 3
+
+
+def test_broadcast_command_validates_pool_size():
+    for option in ("--workers=0", "--partitions=0"):
+        with pytest.raises(CommandError):
+            call_command("fcm_broadcast", '{"message_body": "Hi"}', option)
+
+
+@override_settings(FCM_DEVICES_DB_BATCH_SIZE=2)
+def test_broadcast_partitions_user_ids(tmp_path):
+    path = tmp_path / "users.txt"
+    path.write_text("9\n3\n\n5\n3\n1\n7\n")
+    assert read_user_ids(str(path)) == (1, 3, 5, 7, 9)
+    # no more than DB_BATCH_SIZE users per partition
+    audience = {"user_ids_file": str(path)}
+    assert partition(audience, 1) == [[0, 2], [2, 4], [4, 6]]
+    assert len(partition(audience, 5)) == 5
+    empty = tmp_path / "empty.txt"
+    empty.write_text("")
+    assert partition({"user_ids_file": str(empty)}, 4) == []
+
+
+def test_broadcast_stops_when_a_worker_dies(mocker):
+    mocker.patch("fcm_devices.broadcast.multiprocessing.Pool")
+    reports = mocker.patch("fcm_devices.broadcast.multiprocessing.Queue")
+    reports.return_value.get.side_effect = queue.Empty
+    workers = [mocker.Mock(pid=pid) for pid in (1, 2)]
+    mocker.patch(
+        "fcm_devices.broadcast.multiprocessing.active_children",
+        side_effect=[workers, workers, workers[:1]],
+    )
+    broadcast = Broadcast({"message_body": "Hi"}, {}, workers=2)
+    broadcast.partitions = [{"start": 1, "end": None, "after": None, "done": False}]
+    with pytest.raises(BroadcastError):
+        broadcast.run_pool([0])
+
+
+# tests for the outbox
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(
+    FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend",
+    FCM_DEVICES_RETRY_ATTEMPTS=1,
+)
+def test_enqueue_and_drain_notifications(capsys):
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback(
+            {"token-1": "NotRegistered", "token-2": "Unavailable"}
+        ),
+    )
+    devices = [
+        baker.make("fcm_devices.Device", token=f"token-{i}", active=True)
+        for i in range(4)
+    ]
+    inactive = baker.make("fcm_devices.Device", token="token-x", active=False)
+    queued = service.enqueue_notification_bulk(
+        Device.objects.filter(id__in=[d.id for d in devices[:3]]), message_body="Hi"
+    )
+    assert queued == 3
+    service.enqueue_notification(devices[3], message_body="Hello")
+    service.enqueue_notification(inactive, message_body="Hi")
+    assert not responses.calls
+
+    call_command("fcm_drain_outbox", "--once")
+
+    # one multicast per distinct payload
+    assert sorted(
+        json.loads(call.request.body).get("registration_ids", ["token-3"])
+        for call in responses.calls
+    ) == [["token-0", "token-1", "token-2"], ["token-3"]]
+    rows = {
+        row.device.token: row
+        for row in NotificationOutbox.objects.select_related("device")
+    }
+    assert [(rows[f"token-{i}"].status, rows[f"token-{i}"].error) for i in "0123x"] == [
+        ("sent", ""),
+        ("failed", "NotRegistered"),
+        ("pending", "Unavailable"),
+        ("sent", ""),
+        ("failed", "Inactive"),
+    ]
+    assert rows["token-0"].sent_at is not None
+    assert rows["token-2"].attempts == 1
+    assert capsys.readouterr().out == "failed 2, pending 1, sent 2\n"
+
+    # the transient failure is retried later, until it's out of attempts
+    assert outbox.drain() == {}
+    with override_settings(
+        FCM_DEVICES_OUTBOX_MAX_ATTEMPTS=2, FCM_DEVICES_OUTBOX_RETRY_DELAY=0
+    ):
+        assert outbox.drain() == {"failed": 1}
+        assert outbox.drain() == {}
+    assert NotificationOutbox.objects.get(device=devices[2]).attempts == 2
+
+
+@pytest.mark.django_db
+def test_outbox_claims_rows_once(mocker):
+    rows = [
+        service.enqueue_notification(
+            baker.make("fcm_devices.Device"), message_body="Hi"
+        )
+        for _ in range(3)
+    ]
+    claimed_at, claimed = outbox.claim(2)
+    assert claimed == rows[:2]
+    assert claimed[0].claimed_at == claimed_at
+    # claimed rows are left to their worker
+    assert outbox.claim(10)[1] == rows[2:]
+    assert outbox.claim(10)[1] == []
+    # until its lease runs out
+    NotificationOutbox.objects.filter(id=rows[0].id).update(
+        claimed_at=rows[0].created_at - timedelta(hours=1)
+    )
+    [reclaimed] = outbox.claim(10)[1]
+    assert reclaimed == rows[0]
+    assert reclaimed.attempts == 2
+    # and once out of attempts, abandoned rows are failed rather than reclaimed
+    NotificationOutbox.objects.filter(id=rows[0].id).update(
+        claimed_at=rows[0].created_at - timedelta(hours=1)
+    )
+    with override_settings(FCM_DEVICES_OUTBOX_MAX_ATTEMPTS=2):
+        assert outbox.claim(10)[1] == []
+    reclaimed.refresh_from_db()
+    assert (reclaimed.status, reclaimed.error) == ("failed", "Abandoned")
+
+
+@pytest.mark.django_db
+def test_outbox_leaves_reclaimed_rows_to_their_new_worker(mocker):
+    device = baker.make("fcm_devices.Device", active=True)
+    one = service.enqueue_notification(device, message_body="one")
+    two = service.enqueue_notification(device, message_body="two")
+    later = timezone.now() + timedelta(hours=1)
+
+    def reclaim_both(devices, **kwargs):
+        # our lease ran out while sending, and another worker took both rows
+        NotificationOutbox.objects.update(claimed_at=later)
+        result = fcm.BulkResult()
+        result.add(devices, {"success": 1, "failure": 0, "results": [{}]})
+        return result
+
+    send_bulk = mocker.patch.object(
+        fcm.ConsoleFCMBackend, "send_bulk", side_effect=reclaim_both
+    )
+    assert outbox.drain() == {}
+    # the second payload isn't sent, and neither outcome is recorded over theirs
+    assert send_bulk.call_count == 1
+    for row in (one, two):
+        row.refresh_from_db()
+        assert (row.status, row.claimed_at) == ("sending", later)
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_outbox_releases_rows_on_configuration_error():
+    responses.add(
+        responses.POST, FCMNotification.FCM_END_POINT, json=configuration_error_response
+    )
+    row = service.enqueue_notification(
+        baker.make("fcm_devices.Device", active=True), message_body="Hi"
+    )
+    with pytest.raises(ImproperlyConfigured):
+        outbox.drain()
+    row.refresh_from_db()
+    assert row.status == "pending"
+
+
+@responses.activate
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BACKEND_CLASS="fcm_devices.fcm.FCMBackend")
+def test_outbox_keeps_sent_rows_when_a_later_payload_raises(mocker):
+    responses.add_callback(
+        responses.POST,
+        FCMNotification.FCM_END_POINT,
+        callback=multicast_callback({}),
+    )
+    send_bulk = fcm.FCMBackend.send_bulk
+
+    def raise_for_second_payload(self, devices, **kwargs):
+        if kwargs["message_body"] == "two":
+            raise ConnectionError()
+        return send_bulk(self, devices, **kwargs)
+
+    mocker.patch.object(fcm.FCMBackend, "send_bulk", raise_for_second_payload)
+    device = baker.make("fcm_devices.Device", active=True)
+    one = service.enqueue_notification(device, message_body="one")
+    two = service.enqueue_notification(device, message_body="two")
+    with pytest.raises(ConnectionError):
+        outbox.drain()
+    one.refresh_from_db()
+    two.refresh_from_db()
+    # the first went out, so mustn't be sent again
+    assert one.status == "sent"
+    assert two.status == "pending"
+
+
+# tests for pruning
+
+
+@pytest.mark.django_db
+def test_prune_devices_command(mocker, capsys):
+    sleep = mocker.patch("fcm_devices.prune.time.sleep")
+    pruned_signal = mocker.patch("fcm_devices.prune.devices_pruned.send")
+    now = timezone.now()
+    devices = baker.make("fcm_devices.Device", active=True, _quantity=6)
+    ages = {
+        # inactive for a while
+        devices[0]: (False, 40),
+        # recently deactivated
+        devices[1]: (False, 5),
+        # not seen for a long time
+        devices[2]: (True, 300),
+        devices[4]: (True, 300),
+    }
+    for device, (active, days) in ages.items():
+        Device.objects.filter(id=device.id).update(
+            active=active, updated_at=now - timedelta(days=days)
+        )
+    # an outbox row doesn't stop its device being deleted
+    baker.make("fcm_devices.NotificationOutbox", device=devices[0], payload="{}")
+
+    with pytest.raises(CommandError):
+        call_command("fcm_prune_devices")
+    with pytest.raises(CommandError):
+        call_command("fcm_prune_devices", "--inactive-days=30", "--deactivate")
+
+    call_command("fcm_prune_devices", "--stale-days=270", "--deactivate", "--dry-run")
+    call_command(
+        "fcm_prune_devices", "--inactive-days=30", "--stale-days=270", "--dry-run"
+    )
+    assert capsys.readouterr().out.splitlines() == [
+        "Would deactivate 2 devices",
+        "Would delete 3 devices",
+    ]
+    assert Device.objects.count() == 6
+
+    call_command("fcm_prune_devices", "--stale-days=270", "--deactivate")
+    assert set(Device.objects.filter(active=False).values_list("id", flat=True)) == {
+        devices[0].id,
+        devices[1].id,
+        devices[2].id,
+        devices[4].id,
+    }
+    pruned_signal.reset_mock()
+
+    # deactivating restarted the clock, so only the long inactive device goes
+    call_command(
+        "fcm_prune_devices",
+        "--inactive-days=30",
+        "--stale-days=270",
+        "--chunk-size=2",
+        "--sleep=0.5",
+    )
+    assert capsys.readouterr().out.splitlines()[-1] == "Deleted 1 devices"
+    assert not Device.objects.filter(id=devices[0].id).exists()
+    assert Device.objects.count() == 5
+    pruned_signal.assert_called_once_with(
+        sender=Device,
+        device_ids=[devices[0].id],
+        user_ids=[devices[0].user_id],
+        deleted=True,
+    )
+    sleep.assert_called_with(0.5)
+
+
+@pytest.mark.django_db
+def test_prune_devices_in_id_ranges(mocker):
+    mocker.patch("fcm_devices.prune.time.sleep")
+    pruned_signal = mocker.patch("fcm_devices.prune.devices_pruned.send")
+    devices = baker.make("fcm_devices.Device", active=False, _quantity=5)
+    Device.objects.update(updated_at=timezone.now() - timedelta(days=10))
+
+    assert prune_devices(inactive_days=7, chunk_size=2) == 5
+    assert [call[1]["device_ids"] for call in pruned_signal.call_args_list] == [
+        [device.id for device in devices[:2]],
+        [device.id for device in devices[2:4]],
+        [devices[4].id],
+    ]
+    assert not Device.objects.exists()
+    assert prune_devices(inactive_days=7) == 0
+
+
 # tests for API
 
 
@@ -292,6 +1826,92 @@ def test_create_device_duplicate(api_client):
     assert new_device == device
 
 
+@pytest.mark.django_db
+def test_create_devices_bulk(api_client, mocker):
+    user = baker.make("auth.User")
+    unchanged = baker.make(
+        "fcm_devices.Device", user=user, token="unchanged", name="Pixel", type="ios"
+    )
+    changed = baker.make(
+        "fcm_devices.Device", user=user, token="changed", name="Pixel", type="ios"
+    )
+    devices_created_signal = mocker.patch(
+        "fcm_devices.service.signals.devices_created.send"
+    )
+    devices_updated_signal = mocker.patch(
+        "fcm_devices.service.signals.devices_updated.send"
+    )
+    api_client.force_authenticate(user)
+    payload = [
+        {"name": "Pixel", "active": True, "type": "ios", "token": token}
+        for token in ("new-1", "unchanged", "changed", "new-2")
+    ]
+    payload[2]["active"] = False
+    response = api_client.post(reverse("devices-bulk"), payload, format="json")
+    assert response.status_code == 201
+    assert [(item["token"], item["status"]) for item in response.data] == [
+        ("new-1", "created"),
+        ("unchanged", "unchanged"),
+        ("changed", "updated"),
+        ("new-2", "created"),
+    ]
+    assert user.devices.count() == 4
+    changed.refresh_from_db()
+    assert not changed.active
+    assert user.devices.get(token="unchanged").updated_at == unchanged.updated_at
+
+    created = devices_created_signal.call_args[1]["devices"]
+    assert [device.token for device in created] == ["new-1", "new-2"]
+    devices_updated_signal.assert_called_once_with(sender=Device, devices=[changed])
+
+
+@pytest.mark.django_db
+def test_create_devices_bulk_duplicate_tokens(api_client):
+    user = baker.make("auth.User")
+    api_client.force_authenticate(user)
+    device = {"name": "Pixel", "active": True, "type": "ios", "token": "dupe"}
+    response = api_client.post(reverse("devices-bulk"), [device, device], format="json")
+    assert response.status_code == 400
+    assert not user.devices.exists()
+
+
+@pytest.mark.django_db
+def test_create_devices_bulk_defaults_active(api_client):
+    user = baker.make("auth.User")
+    api_client.force_authenticate(user)
+    payload = [
+        {"name": "Pixel", "type": "ios", "token": "new-1"},
+        {"name": "Pixel", "active": False, "type": "ios", "token": "new-2"},
+    ]
+    response = api_client.post(reverse("devices-bulk"), payload, format="json")
+    assert response.status_code == 201
+    # leaving active out of every device works too
+    response = api_client.post(
+        reverse("devices-bulk"),
+        [{"name": "Pixel", "type": "ios", "token": "new-3"}],
+        format="json",
+    )
+    assert response.status_code == 201
+    assert dict(user.devices.values_list("token", "active")) == {
+        "new-1": True,
+        "new-2": False,
+        "new-3": True,
+    }
+
+
+@pytest.mark.django_db
+@override_settings(FCM_DEVICES_BULK_MAX_DEVICES=2)
+def test_create_devices_bulk_limited(api_client):
+    user = baker.make("auth.User")
+    api_client.force_authenticate(user)
+    payload = [
+        {"name": "Pixel", "type": "ios", "token": f"token-{i}"} for i in range(3)
+    ]
+    response = api_client.post(reverse("devices-bulk"), payload, format="json")
+    assert response.status_code == 400
+    assert not user.devices.exists()
+
+
 # test admin send action
 
 